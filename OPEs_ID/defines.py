@@ -7,6 +7,7 @@ ELECTRON_MASS = 5.48579909065e-4
 
 @enum.unique
 class ColumnNames(StrEnum):
+    SampleID = "SampleID"
     SpecMZ = "SpecMZ"
     SpecINT = "SpecINT"
     RT = "RT"
@@ -1,4 +1,4 @@
-from .cls import Isotope, Element
+from .cls import Isotope, Element, IsotopeDistribution, isotope_pattern
 import json
 import pathlib
 
@@ -8,4 +8,4 @@ with open(pathlib.Path(__file__).parent / "element_data.json") as f:
     db = json.load(f)
 EDB = ElementDB(db)
 
-__all__ = ['Isotope', 'Element', 'EDB']
+__all__ = ['Isotope', 'Element', 'IsotopeDistribution', 'isotope_pattern', 'EDB']
@@ -1,5 +1,6 @@
 import dataclasses
-import itertools
+import functools
+import operator
 import re
 from collections.abc import Mapping
 from functools import cached_property, lru_cache
@@ -17,6 +18,32 @@ class IsotopeDistribution(NamedTuple):
     names: npt.NDArray[np.str_]
 
 
+def _isotope_compositions(n: int, abundance: np.ndarray, min_abundance: float = 0) -> np.ndarray:
+    """
+    Counts of every isotope in the compositions of `n` atoms, in lexicographic order,
+    without the compositions whose abundance is surely below `min_abundance`.
+    """
+    # abundance of the isotope among the ones not placed yet
+    share = abundance / np.cumsum(abundance[::-1])[::-1]
+    counts = np.zeros((1, 0), dtype=np.int64)
+    remaining = np.array([n], dtype=np.int64)
+    prob = np.ones(1)
+    for q in share[:-1]:
+        # every state is followed by 0 to `remaining` atoms of this isotope
+        lengths = remaining + 1
+        state = np.repeat(np.arange(remaining.size), lengths)
+        c = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        left = remaining[state]
+        if min_abundance > 0:
+            # binomial probabilities are at most 1, the abundance can only decrease down the chain
+            p = prob[state] * binom(left, c) * q ** c * (1 - q) ** (left - c)
+            keep = p >= min_abundance * (1 - 1e-9)
+            state, c, left, prob = state[keep], c[keep], left[keep], p[keep]
+        counts = np.column_stack([counts[state], c])
+        remaining = left - c
+    return np.column_stack([counts, remaining])
+
+
 @dataclasses.dataclass(eq=True, order=True, frozen=True)
 class Isotope:
     symbol: str
@@ -90,30 +117,67 @@ class Element:
         return max(self.isotopes, key=lambda x: x.abundance)
 
     @lru_cache(maxsize=128)
-    def isotopes_distribution(self, n: int):
+    def isotopes_distribution(
+        self, n: int, min_abundance: float = 0, nominal: bool = False, names: bool = True
+    ) -> IsotopeDistribution:
+        """
+        Isotope distribution of `n` atoms of the element.
+
+        The isotope compositions are generated directly as a chain of binomial draws
+        (first isotope among all, second among the others, ...), so only compositions
+        summing to `n` are visited, and branches below `min_abundance` are cut early.
+
+        Parameters
+        ----------
+        n : int
+            Number of atoms.
+        min_abundance : float, optional
+            Compositions less abundant are dropped, by default 0
+        nominal : bool, optional
+            Merge the compositions of the same nominal mass, with their abundance weighted mean mass,
+            named after the most abundant one. Coarse, but much shorter for heavy elements. By default False
+        names : bool, optional
+            Build the `ChemFormula` of every peak, by default True
+
+        Returns
+        -------
+        IsotopeDistribution
+            Fine structure in the order of the compositions (sorted as the counts of the isotopes),
+            or nominal masses in increasing order. `names` is None if not asked for.
+        """
         from ..expr import ChemFormula
 
         isotope_mass = np.asarray([iso.mass for iso in self.isotopes], float)
         abundance = np.asarray([iso.abundance for iso in self.isotopes], float)
 
-        combinations = np.array(
-            [
-                c
-                for c in itertools.product(range(n + 1), repeat=len(self.isotopes))
-                if sum(c) == n
-            ]
-        )
+        combinations = _isotope_compositions(n, abundance, min_abundance)
         cumsum_comb = combinations.cumsum(1)
         N = np.full_like(cumsum_comb, n)
         N[:, 1:] -= cumsum_comb[:, :-1]
 
         freq = binom(N, combinations)
         distribution = np.prod(np.power(abundance, combinations) * freq, 1)
+        if min_abundance > 0:
+            keep = distribution >= min_abundance
+            combinations, distribution = combinations[keep], distribution[keep]
         atomic_weight = np.sum(isotope_mass * combinations, 1)
-        names = np.asarray(
-            [ChemFormula(dict(zip(self.isotopes, c))).simplify() for c in combinations]
-        )
 
+        if nominal:
+            mass_number = combinations @ np.asarray([iso.mass_number for iso in self.isotopes])
+            bins, inverse = np.unique(mass_number, return_inverse=True)
+            total = np.bincount(inverse, weights=distribution, minlength=bins.size)
+            atomic_weight = np.bincount(inverse, weights=atomic_weight * distribution, minlength=bins.size) / total
+            # most abundant composition of every bin
+            order = np.lexsort((-distribution, inverse))
+            combinations = combinations[order[np.searchsorted(inverse[order], np.arange(bins.size))]]
+            distribution = total
+
+        if names:
+            names = np.asarray(
+                [ChemFormula(dict(zip(self.isotopes, c))).simplify() for c in combinations]
+            )
+        else:
+            names = None
         return IsotopeDistribution(atomic_weight, distribution, names)
 
     def fuzzy_find(self, mass):
@@ -133,6 +197,89 @@ class Element:
         return fr"$\mathrm{{{self.symbol}}}: {self.standard_atomic_weight:.4f}$"
 
 
+def isotope_pattern(
+    elements: Mapping["str | Element", int],
+    min_abundance: float = 0,
+    resolution: float | None = None,
+    names: bool = False,
+) -> IsotopeDistribution:
+    """
+    Isotope pattern of a molecule, by combining the isotope distribution of its elements one at a time.
+
+    After each element, peaks below `min_abundance` are dropped (their abundance can only decrease
+    with the next elements) and peaks closer than `resolution` are merged, so the number of peaks
+    stays bounded instead of being the product of the numbers of peaks of every element.
+    Without pruning nor merging, gives every isotope combination, like their Cartesian product.
+
+    Parameters
+    ----------
+    elements : Mapping[str | Element, int]
+        Number of atoms of every element.
+    min_abundance : float, optional
+        Peaks less abundant are dropped, by default 0
+    resolution : float | None, optional
+        Peaks closer (in Da) are merged into one, with their summed abundance at their abundance weighted
+        mean mass, named after the most abundant. By default None (no merging)
+    names : bool, optional
+        Build the `ChemFormula` of every peak, by default False
+
+    Returns
+    -------
+    IsotopeDistribution
+        Peaks sorted by mass, `names` is None if not asked for.
+    """
+    from . import EDB
+
+    mass = np.zeros(1)
+    distribution = np.ones(1)
+    # peak of every element, to name the peaks at the end
+    composition = np.zeros((1, 0), dtype=np.int64)
+    element_names = []
+    for ele, n in elements.items():
+        if n == 0:
+            continue
+        if isinstance(ele, str):
+            ele = EDB[ele]
+        aw, dist, ele_names = ele.isotopes_distribution(n, min_abundance, names=names)
+        element_names.append(ele_names)
+        # same order as `itertools.product(peaks, element peaks)`
+        mass = (mass[:, None] + aw).ravel()
+        distribution = (distribution[:, None] * dist).ravel()
+        composition = np.column_stack(
+            [np.repeat(composition, aw.size, axis=0), np.tile(np.arange(aw.size), composition.shape[0])]
+        )
+        if min_abundance > 0:
+            keep = distribution >= min_abundance
+            mass, distribution, composition = mass[keep], distribution[keep], composition[keep]
+        if resolution is not None and mass.size > 1:
+            mass, distribution, composition = _merge_peaks(mass, distribution, composition, resolution)
+
+    order = np.argsort(mass)
+    mass, distribution, composition = mass[order], distribution[order], composition[order]
+    if names:
+        from ..expr import ChemFormula
+
+        peak_names = np.empty(mass.size, dtype=object)
+        for i, comp in enumerate(composition):
+            parts = [ele_names[k] for ele_names, k in zip(element_names, comp)]
+            peak_names[i] = functools.reduce(operator.add, parts) if parts else ChemFormula({})
+    else:
+        peak_names = None
+    return IsotopeDistribution(mass, distribution, peak_names)
+
+
+def _merge_peaks(mass: np.ndarray, distribution: np.ndarray, composition: np.ndarray, resolution: float):
+    # peaks are chained into a group while the gap to the previous one is within `resolution`
+    order = np.argsort(mass, kind="stable")
+    mass, distribution, composition = mass[order], distribution[order], composition[order]
+    starts = np.flatnonzero(np.concatenate([[True], np.diff(mass) > resolution]))
+    total = np.add.reduceat(distribution, starts)
+    merged_mass = np.add.reduceat(mass * distribution, starts) / total
+    group = np.repeat(np.arange(starts.size), np.diff(np.append(starts, mass.size)))
+    apex = np.lexsort((-distribution, group))[starts]
+    return merged_mass, total, composition[apex]
+
+
 class ElementDB(Mapping):
     def __init__(self, db: list[dict]) -> None:
         self.symbol_map = {}
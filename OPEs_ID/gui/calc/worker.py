@@ -9,8 +9,8 @@ from OPEs_ID.expr import ChemFormula
 from OPEs_ID.formula import predict_formula
 from OPEs_ID.io import load_mzml
 from OPEs_ID.isotope_predict import predict_isotope
-from OPEs_ID.ms2_tools import is_mass_in
-from OPEs_ID.tools import ms2_ms1_roi, search_from_another_ms1
+from OPEs_ID.ms2_tools import screen_ions
+from OPEs_ID.tools import eic_matrix, ms2_ms1_roi
 from OPEs_ID.utils import ProgressParallel
 from .progress_adaptor import ProgressAdaptor
 from ..config import config as CONFIG
@@ -90,11 +90,8 @@ class CalcWorker(QObject):
         # SCREEN MS2
         target_ions = CONFIG['target_ion.ions']
         MS2_FILTER_MASS_ACC = CONFIG['target_ion.mass_acc']
-        dic = {}
-        target_ions = ProgressAdaptor(self, "ms2_screen", 0, 100)(target_ions)
-        for ion in target_ions:
-            dic[ion.refname] = is_mass_in(ms2_pos[_C.SpecMZ], ion.mass, rtol=MS2_FILTER_MASS_ACC)
-        search_results = pd.DataFrame(dic, index=ms2_pos.index)
+        search_results = screen_ions(ms2_pos, target_ions, rtol=0, atol=MS2_FILTER_MASS_ACC)
+        self.progressUpdate.emit("ms2_screen", 100)
         hit_sel = search_results.any(axis=1)
         arly_ions_names = [ion.refname for ion in target_ions if ion.type == 'Aryl']
         hit_results = search_results[hit_sel]
@@ -145,12 +142,19 @@ class CalcWorker(QObject):
 
         # CHECK tri-/di-/mono-esters
         tri_pos = []
+        masses, rt_range, ms1ints = [], [], []
         for ms2_idx, rt, precursor_mz, ms1int, formulas in self.calc_data["FragMS2PeakWithFormula"][
             [_C.RT, _C.PrecursorMZ, _C.PrecursorMS1Int, _C.FormulaList]].itertuples():
-            for f in ProgressAdaptor(self, "tri-ester", 0, 100)(formulas):
-                mass = drop2H(f).mass
-                tic_int = search_from_another_ms1(mass, rt, ms1_neg, 5e-6, rt_atol=60)
-                tri_pos.append((ms2_idx, f, (precursor_mz - f.mass) / f.mass, ms1int > tic_int))
+            for f in formulas:
+                masses.append(drop2H(f).mass)
+                rt_range.append((rt - 60, rt + 60))
+                ms1ints.append(ms1int)
+                tri_pos.append((ms2_idx, f, (precursor_mz - f.mass) / f.mass))
+        # EICs of all formulas in the negative MS1 scans at once, only the points in their RT windows
+        eic_points = eic_matrix(masses, ms1_neg, 5e-6, rt_range=rt_range, sparse=True)
+        tic_int = eic_points.groupby("Target")["EIC_INT"].max().reindex(range(len(masses)))
+        tri_pos = [(*row, ms1int > tic) for row, ms1int, tic in zip(tri_pos, ms1ints, tic_int)]
+        self.progressUpdate.emit("tri-ester", 100)
 
         self.check_cancel()
         tri_pos_df = pd.DataFrame(tri_pos, columns=[_C.MS2IDX, _C.Formula, "Deviation", "Tri-ester"])
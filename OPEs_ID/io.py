@@ -1,12 +1,30 @@
+import hashlib
+import io
+import json
 import math
-from collections import namedtuple
+import os
+import re
+import shutil
+import warnings
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Literal, Optional
+from xml.etree import ElementTree
 
+import joblib
 import numpy as np
 import pandas as pd
 import pymzml
 
 from .defines import ColumnNames as C
 from .mtype import ProgressFunc, check_progress
+from .utils import ProgressParallel
+from .spectra import MZ_QUANTUM, CorruptedStoreError, SpectrumStore, SpectrumStoreBuilder, quantize_mz
+
+CACHE_SUFFIX = ".opescache"
+# bump when the parsing changes, so that old caches are not used anymore
+CACHE_VERSION = 2
+_CACHE_MANIFEST = "cache.json"
 
 
 def load_mzml(
@@ -14,64 +32,531 @@ def load_mzml(
         load_ms1=True,
         load_ms2=True,
         progress: bool | ProgressFunc = True,
+        *,
+        rt_range: Optional[tuple[float, float]] = None,
+        precursor_mz_range: Optional[tuple[float, float]] = None,
+        mz_range: Optional[tuple[float, float]] = None,
+        min_intensity: float = 0,
+        min_rel_intensity: float = 0,
+        top_n: Optional[int] = None,
+        centroid: bool = False,
+        compact: bool | Literal["quantized"] = False,
+        as_store: bool = False,
+        cache: bool | str | os.PathLike = True,
+        lazy: bool = False,
+        n_jobs: int = 1,
         **pymzml_kwargs,
 ):
-    run = pymzml.run.Reader(filepath, **pymzml_kwargs)  # type: ignore
-    ms1 = []
-    ms2 = []
+    """
+    Load MS1 and MS2 scans from a mzML file.
+
+    Scans and peaks can be filtered while loading, the filters applied are recorded
+    in the `attrs` of the returned stores (and of their DataFrame) under `"filters"`.
 
+    Parameters
+    ----------
+    filepath : str
+        Path of the mzML file.
+    load_ms1, load_ms2 : bool, optional
+        Whether to load MS1/MS2 scans, by default True
+    progress : bool | ProgressFunc, optional
+        If True, show progress using `tqdm.tqdm`. If False, show nothing.
+        Optionally, passing a `ProgressFunc` like object will update progress using this object,
+        by default True.
+    rt_range : tuple[float, float], optional
+        `(min, max)` retention time in seconds, scans outside are skipped before their peaks are decoded.
+        Either bound can be None, by default None
+    precursor_mz_range : tuple[float, float], optional
+        `(min, max)` precursor m/z, MS2 scans outside are skipped before their peaks are decoded,
+        by default None
+    mz_range : tuple[float, float], optional
+        `(min, max)` m/z of the peaks kept, in both MS1 and MS2 scans, by default None
+    min_intensity : float, optional
+        Peaks less intense are dropped, by default 0
+    min_rel_intensity : float, optional
+        Peaks less intense than this fraction of the most intense peak of their scan
+        (in `mz_range`) are dropped, by default 0
+    top_n : int, optional
+        Keep at most the `top_n` most intense peaks of every scan, by default None
+    centroid : bool, optional
+        Centroid profile spectra with `pymzml` before any other peak filter,
+        centroided spectra are kept as is, by default False
+    compact : bool | "quantized", optional
+        If True, store intensities as float32, halving their memory.
+        If "quantized", also store m/z as uint32 multiples of `MZ_QUANTUM` (2**-20 Da),
+        with an error of at most 4.8e-7 Da (< 0.005 ppm above m/z 100), for m/z below 4096.
+        Stores decode m/z to float64 when they are read (`SpectrumStore.scan`, `frame`, ...),
+        so searches keep their precision. The DataFrame view holds the decoded m/z and gives up
+        the savings, so "quantized" requires `as_store=True`, by default False
+    as_store : bool, optional
+        If True, return `SpectrumStore` objects, which keep all peaks in contiguous arrays.
+        Else, return the DataFrame view of the stores (`SpectrumStore.frame`), by default False
+    cache : bool | str | os.PathLike, optional
+        Cache the parsed scans on disk, so that the next call with the same file and options
+        reads the cache instead of parsing the mzML file.
+        If True, the cache is a `.opescache` directory next to the mzML file.
+        If a path, caches are kept in this directory. If False, do not use the cache.
+        A cache is ignored and rewritten if the mzML file has changed (size or modification time)
+        or if its files are corrupted, by default True
+    lazy : bool, optional
+        If True, peaks are memory-mapped from the cache and only read from disk when used,
+        only the scan information is kept in memory. The peaks are written to the cache while
+        parsing, so a run never needs to fit in memory. The checksums of the peak files are
+        not verified in this mode, only their size. Requires `cache`, by default False
+    n_jobs : int, optional
+        Number of processes decoding the spectra, -1 to use all CPUs.
+        The spectra are split into chunks by their byte offsets (from the index of the mzML file,
+        or from a quick scan of the file without index), which are decoded in parallel.
+        Gzipped files are always read by one process, by default 1
+    **pymzml_kwargs
+        Passed to `pymzml.run.Reader`.
+
+    Returns
+    -------
+    tuple
+        `(ms1, ms2)`, None for the level not loaded.
+    """
+    if compact == "quantized" and not as_store:
+        raise ValueError('`compact="quantized"` needs `as_store=True`, the DataFrame view decodes all m/z.')
     progress = check_progress(progress)
+    scan_filter = dict(
+        load_ms1=load_ms1,
+        load_ms2=load_ms2,
+        rt_range=rt_range,
+        precursor_mz_range=precursor_mz_range,
+        mz_range=mz_range,
+        min_intensity=min_intensity,
+        min_rel_intensity=min_rel_intensity,
+        top_n=top_n,
+        centroid=centroid,
+        compact=compact,
+    )
+    attrs = {"filters": {
+        k: list(v) if isinstance(v, tuple) else v
+        for k, v in scan_filter.items() if k not in ("load_ms1", "load_ms2", "compact")
+    }}
+    cache_dir = key = None
+    if cache is not False and isinstance(filepath, (str, os.PathLike)):
+        key = _cache_key(filepath, **scan_filter, **pymzml_kwargs)
+        cache_dir = _cache_dir(filepath, cache, key)
+        stores = _read_cache(cache_dir, key, progress, mmap_mode="r" if lazy else None)
+        if stores is not None:
+            return _output(stores, as_store)
+    if lazy and cache_dir is None:
+        raise ValueError("`lazy=True` needs `cache` and a file path.")
 
-    for spec in progress(run, total=run.get_spectrum_count()):
-        mslevel = spec.ms_level
-        mz = spec.mz
-        int_ = spec.i
-        rt = spec.scan_time_in_minutes() * 60
-        sortarg = mz.argsort()
-        mz = mz[sortarg]
-        int_ = int_[sortarg]
-
-        if mslevel == 1 and load_ms1:
-            ms1.append((rt, mz, int_))
-        elif mslevel == 2 and load_ms2:
-            (precursor,) = spec.selected_precursors
-            ms2.append((rt, precursor["mz"], precursor["i"], precursor.get("charge", math.nan), mz, int_))
-    if load_ms1:
-        ms1 = pd.DataFrame(ms1, columns=[C.RT, C.SpecMZ, C.SpecINT])
+    tmp_dir = None
+    if cache_dir is not None:
+        tmp_dir = cache_dir.with_name(f"{cache_dir.name}.tmp{os.getpid()}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    # in lazy mode, peaks go straight to the cache files
+    ms1_builder = SpectrumStoreBuilder(tmp_dir / "ms1" if lazy else None)
+    ms2_builder = SpectrumStoreBuilder(tmp_dir / "ms2" if lazy else None)
+    ms1 = []
+    ms2 = []
 
-        ms1.sort_values(C.RT, inplace=True, ignore_index=True)
-        ms1.index.name = C.MS1IDX
+    run = pymzml.run.Reader(filepath, **pymzml_kwargs)  # type: ignore
+    if n_jobs != 1 and _is_plain_file(filepath):
+        scans = _read_scans_parallel(filepath, run, n_jobs, progress, scan_filter)
+    else:
+        scans = (
+            scan for spec in progress(run, total=run.get_spectrum_count())
+            if (scan := _read_scan(spec, **scan_filter)) is not None
+        )
+    for mslevel, info, mz, int_ in scans:
+        if mslevel == 1:
+            ms1.append(info)
+            ms1_builder.append(mz, int_)
+        else:
+            ms2.append(info)
+            ms2_builder.append(mz, int_)
+    mz_scale = MZ_QUANTUM if compact == "quantized" else None
+    if load_ms1:
+        ms1 = _build_store(ms1_builder, ms1, [C.RT], attrs, mz_scale)
+        ms1.meta.index.name = C.MS1IDX
     else:
         ms1 = None
     if load_ms2:
-        ms2 = pd.DataFrame(
-            ms2,
-            columns=[
-                C.RT,
-                C.PrecursorMZ,
-                C.PrecursorInt,
-                C.Charge,
-                C.SpecMZ,
-                C.SpecINT,
-            ],
-        )
-        ms2.sort_values(C.RT, inplace=True, ignore_index=True)
-        ms2.index.name = C.MS2IDX
+        ms2 = _build_store(ms2_builder, ms2, [C.RT, C.PrecursorMZ, C.PrecursorInt, C.Charge], attrs, mz_scale)
+        ms2.meta.index.name = C.MS2IDX
     else:
         ms2 = None
     if load_ms1 and load_ms2:
-        def find_int_in_ms1(ms2_s, ms1):
-            ms1_s = ms1.loc[ms2_s[C.MS1IDX], [C.SpecMZ, C.SpecINT]]
-            return ms1_s[C.SpecINT][
-                np.argmin(np.abs(ms2_s[C.PrecursorMZ] - ms1_s[C.SpecMZ]))
-            ]
-
-        ms2[C.MS1IDX] = ms1[C.RT].searchsorted(ms2[C.RT]) - 1
-        ms2.insert(
-            3, C.PrecursorMS1Int, ms2.apply(find_int_in_ms1, axis=1, args=(ms1,))
-        )
-        ms1[C.ProductsIDX] = [
-            ms2.index[ms2[C.MS1IDX] == idx].to_list() for idx in ms1.index
+        _link_precursors(ms1, ms2)
+
+    if cache_dir is not None:
+        written = _write_cache(tmp_dir, key, (ms1, ms2))
+        if lazy:
+            # release the memory maps before moving the files
+            del ms1, ms2
+            if written and _commit_cache(tmp_dir, cache_dir):
+                tmp_dir = cache_dir
+            stores = _read_cache(tmp_dir, key, check_progress(False), mmap_mode="r")
+            if stores is None:
+                raise CorruptedStoreError(f"Failed to write the cache of {filepath}.")
+            return _output(stores, as_store)
+        if written and not _commit_cache(tmp_dir, cache_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return _output((ms1, ms2), as_store)
+
+
+def load_mzml_batch(
+        manifest: Mapping[str, str | os.PathLike] | Sequence[str | os.PathLike],
+        load_ms1=True,
+        load_ms2=True,
+        progress: bool | ProgressFunc = True,
+        *,
+        as_store: bool = False,
+        n_jobs: int = 1,
+        **load_kwargs,
+):
+    """
+    Load many mzML files concurrently into one multi-sample pair of MS1 and MS2 scans.
+
+    Scans of every sample are stacked in the order of `manifest`, with a `SampleID` column
+    in front of the columns of `load_mzml`. The index is renumbered over all samples, and
+    `MS1IDX`/`ProductsIDX` are shifted accordingly, so that the links between scans stay valid.
+
+    Parameters
+    ----------
+    manifest : Mapping[str, str | os.PathLike] | Sequence[str | os.PathLike]
+        Sample ID to mzML path, or mzML paths whose file names (without suffix) are the sample IDs.
+    load_ms1, load_ms2 : bool, optional
+        Whether to load MS1/MS2 scans, by default True
+    progress : bool | ProgressFunc, optional
+        If True, show progress over files using `tqdm.tqdm`. If False, show nothing.
+        Optionally, passing a `ProgressFunc` like object will update progress using this object,
+        by default True.
+    as_store : bool, optional
+        If True, return `SpectrumStore` objects, else their DataFrame view, by default False
+    n_jobs : int, optional
+        Number of files loaded at the same time, -1 to use all CPUs, by default 1
+    **load_kwargs
+        Passed to `load_mzml`, e.g. `cache`, `rt_range` or `mz_range`.
+        The combined scans are held in memory, even with `lazy=True`.
+
+    Returns
+    -------
+    tuple
+        `(ms1, ms2)`, None for the level not loaded.
+    """
+    if load_kwargs.get("compact") == "quantized" and not as_store:
+        raise ValueError('`compact="quantized"` needs `as_store=True`, the DataFrame view decodes all m/z.')
+    if isinstance(manifest, Mapping):
+        samples = list(manifest.items())
+    else:
+        samples = [(Path(path).stem, path) for path in manifest]
+    sample_ids = [sample_id for sample_id, _ in samples]
+    if len(set(sample_ids)) != len(sample_ids):
+        raise ValueError("Sample IDs in the manifest must be unique.")
+
+    tasks = [
+        joblib.delayed(load_mzml)(path, load_ms1, load_ms2, progress=False, as_store=True, **load_kwargs)
+        for _, path in samples
+    ]
+    runs = ProgressParallel(n_jobs=n_jobs)(tasks, progress=check_progress(progress))
+
+    stores = []
+    for level, load in enumerate((load_ms1, load_ms2)):
+        if not load or not runs:
+            stores.append(None)
+            continue
+        level_stores = [run[level] for run in runs]
+        store = SpectrumStore.concat(level_stores, ignore_index=True)
+        store.meta.insert(0, C.SampleID, np.repeat(sample_ids, [len(s) for s in level_stores]))
+        stores.append(store)
+
+    ms1, ms2 = stores
+    if load_ms1 and load_ms2 and runs:
+        # links are positions within each sample, shift them to positions in the combined stores
+        n_ms1 = np.array([len(run[0]) for run in runs])
+        n_ms2 = np.array([len(run[1]) for run in runs])
+        ms1_idx = ms2.meta[C.MS1IDX].to_numpy()
+        ms2.meta[C.MS1IDX] = np.where(ms1_idx >= 0, ms1_idx + np.repeat(np.cumsum(n_ms1) - n_ms1, n_ms2), ms1_idx)
+        ms1.meta[C.ProductsIDX] = [
+            [i + start for i in products]
+            for products, start in zip(ms1.meta[C.ProductsIDX], np.repeat(np.cumsum(n_ms2) - n_ms2, n_ms1).tolist())
         ]
+    return _output((ms1, ms2), as_store)
+
+
+def _link_precursors(ms1: SpectrumStore, ms2: SpectrumStore):
+    # link each MS2 scan to the last MS1 scan before it, in O((N_ms1 + N_ms2) log N_peaks)
+    ms1_idx = ms1.meta[C.RT].searchsorted(ms2.meta[C.RT]) - 1
+    ms2.meta[C.MS1IDX] = ms1_idx
+
+    # intensity of the MS1 peak nearest to the precursor, first of the nearest peaks on ties
+    prec_mz = ms2.meta[C.PrecursorMZ].to_numpy(dtype=np.float64)
+    has_ms1 = ms1_idx >= 0
+    nearest = np.where(has_ms1, ms1.nearest_peak(prec_mz, np.maximum(ms1_idx, 0)), -1)
+    ms1_int = np.full(len(ms2), np.nan)
+    ms1_int[nearest >= 0] = ms1.intensity[nearest[nearest >= 0]]
+    ms2.meta.insert(3, C.PrecursorMS1Int, ms1_int)
+
+    # product scans of each MS1 scan, from one stable sort
+    order = np.argsort(ms1_idx, kind="stable")
+    order = order[has_ms1[order]]
+    counts = np.bincount(ms1_idx[order], minlength=len(ms1))
+    products = ms2.index.to_numpy()[order]
+    ms1.meta[C.ProductsIDX] = [p.tolist() for p in np.split(products, np.cumsum(counts)[:-1])]
+
+
+def _in_range(value: float, range_: Optional[tuple[float, float]]) -> bool:
+    return range_ is None or (
+        (range_[0] is None or value >= range_[0]) and (range_[1] is None or value <= range_[1])
+    )
+
+
+def _read_scan(
+        spec,
+        load_ms1: bool = True,
+        load_ms2: bool = True,
+        rt_range: Optional[tuple[float, float]] = None,
+        precursor_mz_range: Optional[tuple[float, float]] = None,
+        mz_range: Optional[tuple[float, float]] = None,
+        min_intensity: float = 0,
+        min_rel_intensity: float = 0,
+        top_n: Optional[int] = None,
+        centroid: bool = False,
+        compact: bool | Literal["quantized"] = False,
+) -> Optional[tuple]:
+    # (mslevel, scan information, m/z, intensity) of a `pymzml.spec.Spectrum`, None if not loaded.
+    # Scans are filtered on their metadata first, the binary arrays are only decoded for kept scans.
+    mslevel = spec.ms_level
+    if not ((mslevel == 1 and load_ms1) or (mslevel == 2 and load_ms2)):
+        return None
+    rt = spec.scan_time_in_minutes() * 60
+    if not _in_range(rt, rt_range):
+        return None
+    if mslevel == 1:
+        info = (rt,)
+    else:
+        (precursor,) = spec.selected_precursors
+        if not _in_range(precursor["mz"], precursor_mz_range):
+            return None
+        info = (rt, precursor["mz"], precursor["i"], precursor.get("charge", math.nan))
+
+    if centroid:
+        peaks = np.asarray(spec.peaks("centroided"), dtype=np.float64).reshape(-1, 2)
+        mz = peaks[:, 0].copy()
+        int_ = peaks[:, 1].copy()
+    else:
+        mz = spec.mz
+        int_ = spec.i
+    sortarg = mz.argsort()
+    mz = mz[sortarg]
+    int_ = int_[sortarg]
+    if mz_range is not None:
+        start = 0 if mz_range[0] is None else mz.searchsorted(mz_range[0], "left")
+        stop = mz.size if mz_range[1] is None else mz.searchsorted(mz_range[1], "right")
+        # copy, so that the full decoded arrays are released
+        mz = mz[start:stop].copy()
+        int_ = int_[start:stop].copy()
+    if int_.size and (min_intensity > 0 or min_rel_intensity > 0):
+        keep = int_ >= max(min_intensity, min_rel_intensity * int_.max())
+        mz = mz[keep]
+        int_ = int_[keep]
+    if top_n is not None and int_.size > top_n:
+        keep = np.sort(np.argsort(-int_, kind="stable")[:top_n])
+        mz = mz[keep]
+        int_ = int_[keep]
+    if compact:
+        int_ = int_.astype(np.float32)
+    if compact == "quantized":
+        mz = quantize_mz(mz)
+    return mslevel, info, mz, int_
+
+
+def _is_plain_file(filepath) -> bool:
+    if not isinstance(filepath, (str, os.PathLike)):
+        return False
+    with open(filepath, "rb") as f:
+        return f.read(2) != b"\x1f\x8b"  # gzip magic number
+
+
+def _spectrum_offsets(filepath) -> tuple[np.ndarray, int]:
+    """Byte offsets of all `<spectrum>` elements and the end of the last one."""
+    size = os.path.getsize(filepath)
+    offsets = None
+    with open(filepath, "rb") as f:
+        # indexed mzML: the offset of the index is at the end of the file
+        f.seek(max(size - 4096, 0))
+        match = re.search(rb"<indexListOffset>(\d+)</indexListOffset>", f.read())
+        if match is not None:
+            f.seek(int(match.group(1)))
+            index_list = f.read(size - int(match.group(1)))
+            spectrum_index = re.search(rb'<index\s+name="spectrum">(.*?)</index>', index_list, re.DOTALL)
+            if spectrum_index is not None:
+                offsets = np.array(
+                    [int(m) for m in re.findall(rb"<offset[^>]*>(\d+)</offset>", spectrum_index.group(1))],
+                    dtype=np.int64,
+                )
+                f.seek(offsets[0] if offsets.size else 0)
+                if offsets.size and not f.read(10).startswith(b"<spectrum"):
+                    offsets = None  # broken index
+        if offsets is None:
+            # no usable index, find the spectra by scanning the file
+            found = []
+            pos = 0
+            tail = b""
+            f.seek(0)
+            while chunk := f.read(1 << 24):
+                data = tail + chunk
+                found.extend(pos - len(tail) + m.start() for m in re.finditer(rb"<spectrum\s", data))
+                # keep enough bytes to match a tag cut by the chunk boundary
+                tail = data[-16:]
+                pos += len(chunk)
+            offsets = np.unique(np.array(found, dtype=np.int64))
+        f.seek(offsets[-1] if offsets.size else 0)
+        end = offsets[-1] if offsets.size else 0
+        while chunk := f.read(1 << 20):
+            if (i := chunk.find(b"</spectrum>")) != -1:
+                end = f.tell() - len(chunk) + i + len(b"</spectrum>")
+                break
+    return offsets, end
+
+
+def _decode_chunk(
+        filepath, start: int, stop: int, obo_version, ms_precisions: dict, ref_groups: Optional[bytes],
+        scan_filter: dict
+) -> list[tuple]:
+    # decode the spectra in `[start, stop)` bytes of the file like `pymzml.run.Reader` does
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    ns = b'xmlns="http://psi.hupo.org/ms/mzml"'
+    group_element = None
+    if ref_groups is not None:
+        group_element = ElementTree.fromstring(ref_groups.replace(b">", b" " + ns + b">", 1))
+    scans = []
+    for _, element in ElementTree.iterparse(io.BytesIO(b"<spectrumList " + ns + b">" + data + b"</spectrumList>")):
+        if element.tag.endswith("}spectrum"):
+            spec = pymzml.spec.Spectrum(element, obo_version=obo_version)
+            if group_element is not None:
+                spec._set_params_from_reference_group(group_element)
+            spec.measured_precision = ms_precisions[spec.ms_level]
+            if (scan := _read_scan(spec, **scan_filter)) is not None:
+                scans.append(scan)
+            element.clear()
+    return scans
+
+
+def _read_scans_parallel(filepath, run, n_jobs: int, progress: ProgressFunc, scan_filter: dict):
+    offsets, end = _spectrum_offsets(filepath)
+    ref_groups = None
+    if run.info.get("referenceable_param_group_list", False):
+        with open(filepath, "rb") as f:
+            head = f.read(offsets[0] if offsets.size else 0)
+        match = re.search(rb"<referenceableParamGroupList.*?</referenceableParamGroupList>", head, re.DOTALL)
+        ref_groups = None if match is None else match.group(0)
+
+    # a few chunks per process to balance the load
+    n_chunks = min(offsets.size, joblib.effective_n_jobs(n_jobs) * 4)
+    bounds = np.append(offsets, end)[np.linspace(0, offsets.size, n_chunks + 1).astype(np.int64)]
+    tasks = [
+        joblib.delayed(_decode_chunk)(filepath, start, stop, run.OT.version, run.ms_precisions, ref_groups, scan_filter)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    for scans in ProgressParallel(n_jobs=n_jobs, return_as="generator")(tasks, progress=progress):
+        yield from scans
+
+
+def _output(stores: tuple, as_store: bool) -> tuple:
+    if as_store:
+        return stores
+    return tuple(None if store is None else store.frame for store in stores)
+
+
+def _build_store(
+        builder: SpectrumStoreBuilder, scans: list[tuple], columns: list[str], attrs: dict, mz_scale: Optional[float]
+) -> SpectrumStore:
+    meta = pd.DataFrame(scans, columns=columns)
+    store = builder.build(meta, order=np.argsort(meta[C.RT].to_numpy(), kind="stable"), attrs=attrs, mz_scale=mz_scale)
+    store.meta.reset_index(drop=True, inplace=True)
+    return store
+
+
+def _cache_key(filepath, **options) -> dict:
+    path = Path(filepath).resolve()
+    stat = path.stat()
+    return {
+        "version": CACHE_VERSION,
+        "path": str(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "options": {k: repr(v) for k, v in sorted(options.items())},
+    }
+
+
+def _cache_dir(filepath, cache: bool | str | os.PathLike, key: dict) -> Path:
+    path = Path(key["path"])
+    if cache is True:
+        root = path.with_name(path.name + CACHE_SUFFIX)
+    else:
+        path_digest = hashlib.sha1(key["path"].encode()).hexdigest()[:8]
+        root = Path(cache) / f"{path.name}-{path_digest}{CACHE_SUFFIX}"
+    # one sub-directory per set of loading options
+    options_digest = hashlib.sha1(
+        json.dumps([key["version"], key["options"]]).encode()
+    ).hexdigest()[:16]
+    return root / options_digest
+
+
+def _read_cache(
+        cache_dir: Path, key: dict, progress: ProgressFunc, mmap_mode: Optional[str] = None
+) -> Optional[tuple]:
+    try:
+        with open(cache_dir / _CACHE_MANIFEST) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        warnings.warn(f"Ignore unreadable cache {cache_dir}.")
+        return None
+    if manifest.get("key") != key:
+        return None
+
+    stores = []
+    try:
+        for level in progress(("ms1", "ms2"), total=2):
+            if manifest["levels"][level]:
+                stores.append(SpectrumStore.open(cache_dir / level, mmap_mode=mmap_mode))
+            else:
+                stores.append(None)
+    except (CorruptedStoreError, OSError, KeyError, TypeError):
+        warnings.warn(f"Ignore corrupted cache {cache_dir}.")
+        return None
+    return tuple(stores)
+
+
+def _write_cache(tmp_dir: Path, key: dict, stores: tuple) -> bool:
+    try:
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for level, store in zip(("ms1", "ms2"), stores):
+            if store is not None:
+                store.save(tmp_dir / level)
+        manifest = {"key": key, "levels": {level: store is not None for level, store in zip(("ms1", "ms2"), stores)}}
+        # the manifest is written last, a cache without it is never read
+        with open(tmp_dir / _CACHE_MANIFEST, "w") as f:
+            json.dump(manifest, f)
+    except (OSError, TypeError) as e:
+        warnings.warn(f"Failed to write cache {tmp_dir}: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    return True
+
+
+def _commit_cache(tmp_dir: Path, cache_dir: Path) -> bool:
+    try:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+    except OSError as e:
+        warnings.warn(f"Failed to write cache {cache_dir}: {e}")
+        return False
+    return True
+
 
-    return ms1, ms2
+def clear_cache(filepath: str | os.PathLike, cache: bool | str | os.PathLike = True) -> None:
+    """Remove all the caches of `filepath` created by `load_mzml` with the same `cache` argument."""
+    key = _cache_key(filepath)
+    shutil.rmtree(_cache_dir(filepath, cache, key).parent, ignore_errors=True)
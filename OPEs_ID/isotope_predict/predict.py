@@ -6,6 +6,7 @@ from typing import Callable, Iterable
 from collections.abc import Sequence, Mapping
 from ..elements import Element, EDB
 from ..defines import ColumnNames as C
+from ..spectra import SpectrumStore, as_frame
 
 
 def check_isotope_params(parmas: Mapping[str | Element, Sequence]) -> dict[Element, list]:
@@ -24,10 +25,15 @@ def _ga(named_tup, name):
     return getattr(named_tup, name)
 
 
-def predict_isotope(ms2: pd.DataFrame, ms1: pd.DataFrame, isotope_params: Mapping[str | Element, Sequence | set],
+def predict_isotope(ms2: pd.DataFrame | SpectrumStore, ms1: pd.DataFrame | SpectrumStore,
+                    isotope_params: Mapping[str | Element, Sequence | set],
                     mass_acc=5e-6, top_n=5, *,
-                    progress: ProgressFunc | bool = True):
+                    progress: ProgressFunc | bool = True,
+                    cache_dir=None,
+                    max_candidates=None):
     progress = check_progress(progress)
+    ms2 = as_frame(ms2)
+    ms1 = as_frame(ms1)
     isotope_params = check_isotope_params(isotope_params)
     isotope_predict = []
     for s in progress(ms2.itertuples(), total=ms2.shape[0]):
@@ -35,6 +41,6 @@ def predict_isotope(ms2: pd.DataFrame, ms1: pd.DataFrame, isotope_params: Mappin
         ms1_int = ms1.at[_ga(s, C.MS1IDX), C.SpecINT]
         r = reverse_search_for_isotopes(
             _ga(s, C.PrecursorMZ), _ga(s, C.PrecursorMS1Int), ms1_mz, ms1_int, isotope_params, mass_acc=mass_acc,
-            top_n=top_n)
+            top_n=top_n, cache_dir=cache_dir, max_candidates=max_candidates)
         isotope_predict.append(r)
     return isotope_predict
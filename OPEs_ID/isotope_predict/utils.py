@@ -1,10 +1,21 @@
 import itertools
+import os
+import warnings
+from pathlib import Path
+from typing import Optional
 
+import joblib
 import numpy as np
 
-from OPEs_ID.elements import EDB, Element
+from OPEs_ID.elements import EDB, Element, IsotopeDistribution, isotope_pattern
 from OPEs_ID.utils import rbf
 
+# bump when the templates change, so that old files in `cache_dir` are not used anymore
+TEMPLATE_VERSION = 1
+
+# templates already computed, by grid and parameters, see `isotope_templates`
+_TEMPLATES: dict[tuple, list[IsotopeDistribution]] = {}
+
 
 def lstq_rbf(int_candi, int_std, int_sigma):
     int_candi = np.asarray(int_candi)
@@ -15,6 +26,20 @@ def lstq_rbf(int_candi, int_std, int_sigma):
     return rbf(delta, 0, int_sigma).min()
 
 
+def lstq_rbf_batch(int_candi, int_std, int_sigma):
+    """
+    `lstq_rbf` of every row of `int_candi`, rows without intensity score 0.
+    """
+    int_candi = np.asarray(int_candi, dtype=float)
+    norm = np.einsum("ij,ij->i", int_candi, int_candi)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        k = (int_candi @ int_std) / norm
+    delta = int_std - int_candi * k[:, None]
+    scores = rbf(delta, 0, int_sigma).min(1)
+    scores[norm == 0] = 0
+    return scores
+
+
 def make_isotope_grid(isotopes_grid: dict[str | Element, list[int]]):
     grid = {}
     for iso, lst in isotopes_grid.items():
@@ -31,42 +56,138 @@ def make_isotope_grid(isotopes_grid: dict[str | Element, list[int]]):
         yield params
 
 
-def get_isotopes_dist(isotopes: dict[Element, int], atol=None, rtol=None, rtol_base=0):
-    isotopes = isotopes.copy()
-    for k in list(isotopes.keys()):
-        if isotopes[k] == 0:
-            del isotopes[k]
-    all_aw, all_dist, all_names = zip(
-        *[ele.isotopes_distribution(n) for (ele, n) in isotopes.items()])
-    atomic_weight = np.asarray([np.sum(aw)
-                                for aw in itertools.product(*all_aw)])
-    distribution = np.asarray([np.prod(dist)
-                               for dist in itertools.product(*all_dist)])
-    names = np.asarray([np.sum(name)
-                        for name in itertools.product(*all_names)])
-    sort = atomic_weight.argsort()
-    atomic_weight = atomic_weight[sort]
-    distribution = distribution[sort]
-    names = names[sort]
+def get_isotopes_dist(isotopes: dict[Element, int], atol=None, rtol=None, rtol_base=0, min_abundance=0, names=True):
+    atomic_weight, distribution, names = isotope_pattern(isotopes, min_abundance, names=names)
     if atol is None and rtol is None:
         return atomic_weight, distribution, names
-    merged_aw = []
-    merged_dist = []
-    merged_names = []
-    visited = np.zeros_like(atomic_weight, bool)
-    for i in range(visited.size):
-        if not visited[i]:
-            sel = True
-            if atol is not None:
-                sel &= np.abs(atomic_weight - atomic_weight[i]) < atol
-            if rtol is not None:
-                sel &= np.abs(
-                    atomic_weight - atomic_weight[i]) / ((atomic_weight + atomic_weight[i]) / 2 + rtol_base) < rtol
-            merged_aw.append(atomic_weight[sel].mean())
-            merged_dist.append(distribution[sel].prod())
-            merged_names.append(names[sel][0])
-            visited[sel] = True
-    return np.array(merged_aw), np.array(merged_dist), np.array(merged_names, dtype=object)
+    return _merge_close_peaks(atomic_weight, distribution, names, atol, rtol, rtol_base)
+
+
+def _merge_close_peaks(atomic_weight, distribution, names, atol=None, rtol=None, rtol_base=0):
+    """
+    Merge peaks sorted by mass in one sweep: the first peak not merged yet takes every peak
+    close to it (merged ones included), giving their mean mass, the product of their
+    abundances and the first name.
+    """
+    n = atomic_weight.size
+
+    def close(j, i):
+        sel = np.ones(j.size, bool)
+        if atol is not None:
+            sel &= np.abs(atomic_weight[j] - atomic_weight[i]) < atol
+        if rtol is not None:
+            sel &= np.abs(atomic_weight[j] - atomic_weight[i]) / (
+                    (atomic_weight[j] + atomic_weight[i]) / 2 + rtol_base) < rtol
+        return sel
+
+    # the close peaks are contiguous, their bounds are searched with a surely inside
+    # and a surely outside reach, and tested exactly only when both differ
+    inner = np.full(n, np.inf)
+    outer = np.full(n, np.inf)
+    if atol is not None:
+        inner = np.minimum(inner, atol * (1 - 1e-9))
+        outer = np.minimum(outer, atol * (1 + 1e-9))
+    if rtol is not None:
+        ref = np.abs(atomic_weight) + rtol_base
+        inner = np.minimum(inner, rtol * ref / (1 + rtol / 2) * (1 - 1e-9))
+        outer = np.minimum(outer, rtol * ref / (1 - rtol / 2) * (1 + 1e-9))
+    outer += np.spacing(np.abs(atomic_weight) + outer)
+    lo_in = atomic_weight.searchsorted(atomic_weight - inner, "right")
+    hi_in = atomic_weight.searchsorted(atomic_weight + inner, "left")
+    lo_out = atomic_weight.searchsorted(atomic_weight - outer, "left")
+    hi_out = atomic_weight.searchsorted(atomic_weight + outer, "right")
+
+    lows = []
+    highs = []
+    i = 0
+    while i < n:
+        lo, hi = int(lo_out[i]), int(hi_out[i])
+        if lo != lo_in[i] or hi != hi_in[i]:
+            cand = np.flatnonzero(close(np.arange(lo, hi), i)) + lo
+            lo, hi = int(cand[0]), int(cand[-1]) + 1
+        lows.append(lo)
+        highs.append(hi)
+        i = hi
+    lows = np.asarray(lows, dtype=np.int64)
+    highs = np.asarray(highs, dtype=np.int64)
+
+    # [lows[k], highs[k]) at the even positions, whatever lies between is dropped
+    bounds = np.column_stack([lows, highs]).ravel()
+    merged_aw = np.add.reduceat(np.append(atomic_weight, 0), bounds)[::2] / (highs - lows)
+    merged_dist = np.multiply.reduceat(np.append(distribution, 1), bounds)[::2]
+    if names is None:
+        return merged_aw, merged_dist, None
+    return merged_aw, merged_dist, np.array(names[lows], dtype=object)
+
+
+def isotope_templates(isotopes_grid: dict[str | Element, list[int]],
+                      top_n=5,
+                      atol=None,
+                      rtol=None,
+                      rtol_base=0,
+                      cache_dir: Optional[str | os.PathLike] = None,
+                      ) -> list[IsotopeDistribution]:
+    """
+    Isotope pattern of every element combination of `isotopes_grid` (see `make_isotope_grid`),
+    normalized to the most abundant peak and reduced to its `top_n` most abundant peaks.
+
+    The templates of a grid and parameters are computed once, then kept in memory and shared
+    by all the calls, like the MS2 scans of `predict_isotope`. The arrays are read-only.
+
+    Parameters
+    ----------
+    isotopes_grid : dict[str | Element, list[int]]
+        Numbers of atoms of every element.
+    top_n : int, optional
+        Number of peaks kept, all if None, by default 5
+    atol, rtol, rtol_base : optional
+        Merging of close peaks, see `get_isotopes_dist`.
+    cache_dir : str | os.PathLike, optional
+        Also keep the templates in this directory, to be shared across sessions, by default None
+
+    Returns
+    -------
+    list[IsotopeDistribution]
+        Template of every element combination, peaks in increasing abundance.
+    """
+    grid = tuple(
+        ((EDB[ele] if isinstance(ele, str) else ele).symbol, tuple(lst)) for ele, lst in isotopes_grid.items()
+    )
+    key = (grid, top_n, atol, rtol, rtol_base)
+    templates = _TEMPLATES.get(key)
+    if templates is not None:
+        return templates
+
+    path = None
+    if cache_dir is not None:
+        path = Path(cache_dir) / f"isotope-templates-{joblib.hash((TEMPLATE_VERSION, key))}.pkl"
+        if path.exists():
+            try:
+                templates = joblib.load(path)
+            except Exception:
+                warnings.warn(f"Ignore unreadable isotope templates {path}.")
+    if templates is None:
+        templates = []
+        for isotopes_comb in make_isotope_grid(isotopes_grid):
+            atomic_weight, distribution, names = get_isotopes_dist(
+                isotopes_comb, atol=atol, rtol=rtol, rtol_base=rtol_base)
+            distribution /= distribution.max()
+            if top_n is not None:
+                top_idx = np.argsort(distribution)[-top_n:]
+                atomic_weight = atomic_weight[top_idx]
+                distribution = distribution[top_idx]
+                names = names[top_idx]
+            templates.append(IsotopeDistribution(atomic_weight, distribution, names))
+        if path is not None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+            joblib.dump(templates, tmp_path)
+            os.replace(tmp_path, path)
+    for template in templates:
+        template.atomic_weight.flags.writeable = False
+        template.distribution.flags.writeable = False
+    _TEMPLATES[key] = templates
+    return templates
 
 
 def reverse_search_for_isotopes(ms2_mz,
@@ -80,39 +201,36 @@ def reverse_search_for_isotopes(ms2_mz,
                                 atol=None,
                                 rtol=None,
                                 rtol_base=0,
+                                cache_dir=None,
+                                max_candidates=None,
                                 ):
+    ms1_mz = np.asarray(ms1_mz)
+    ms1_int = np.asarray(ms1_int)
     results = []
-    for isotopes_comb in make_isotope_grid(isotopes_grid):
-        atomic_weight, distribution, names = get_isotopes_dist(
-            isotopes_comb, atol=atol, rtol=rtol, rtol_base=rtol_base)
-        distribution /= distribution.max()
-        if top_n is not None:
-            top_idx = np.argsort(distribution)[-top_n:]
-            atomic_weight = atomic_weight[top_idx]
-            distribution = distribution[top_idx]
-            names = names[top_idx]
-
+    for atomic_weight, distribution, names in isotope_templates(
+            isotopes_grid, top_n, atol=atol, rtol=rtol, rtol_base=rtol_base, cache_dir=cache_dir):
         for i in range(atomic_weight.size):
 
             mass_diff = np.delete(atomic_weight, i) - atomic_weight[i]
-            combines = [[ms2_int]]
-            for mz_diff in mass_diff:
-                mz_min = (1 - mass_acc) * (
-                        ms2_mz / (1 + mass_acc) + mz_diff
-                )
-                mz_max = (1 + mass_acc) * (
-                        ms2_mz / (1 - mass_acc) + mz_diff
-                )
-                combines.append(
-                    ms1_int[(mz_min <= ms1_mz) & (ms1_mz <= mz_max)].ravel())
-
-            candidates = tuple(itertools.product(*combines))
-            if len(candidates) != 0:
-                std_int = np.concatenate(
-                    (distribution[i], np.delete(distribution, i)), axis=None)
-                p = max([lstq_rbf(int_candi, std_int, intensity_sigma)
-                         for int_candi in candidates])
-                results.append((p, names[i]))
+            mz_min = (1 - mass_acc) * (ms2_mz / (1 + mass_acc) + mass_diff)
+            mz_max = (1 + mass_acc) * (ms2_mz / (1 - mass_acc) + mass_diff)
+            combines = [np.array([ms2_int], dtype=float)]
+            for lo, hi, mz_diff in zip(mz_min, mz_max, mass_diff):
+                sel = np.flatnonzero((lo <= ms1_mz) & (ms1_mz <= hi))
+                if max_candidates is not None and sel.size > max_candidates:
+                    # the peaks closest to the expected m/z
+                    dist = np.abs(ms1_mz[sel] - (ms2_mz + mz_diff))
+                    sel = np.sort(sel[np.argsort(dist, kind="stable")[:max_candidates]])
+                combines.append(ms1_int[sel])
+            if any(c.size == 0 for c in combines):
+                continue
+
+            # every combination of the peaks of the windows, in rows
+            candidates = np.stack([g.ravel() for g in np.meshgrid(*combines, indexing="ij")], axis=1)
+            std_int = np.concatenate(
+                (distribution[i], np.delete(distribution, i)), axis=None)
+            p = lstq_rbf_batch(candidates, std_int, intensity_sigma).max()
+            results.append((p, names[i]))
     r = max(results, default=None, key=lambda x: x[0])
     if r is None or r[0] < 0.8:
         return None
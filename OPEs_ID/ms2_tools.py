@@ -1,9 +1,19 @@
-from typing import Sequence
+import os
+from typing import Optional, Sequence
 
 import numpy as np
+import pandas as pd
 from numpy.typing import ArrayLike
 
-__all__ = ["is_mass_in"]
+from .defines import ColumnNames as C
+from .spectra import CorruptedStoreError, SpectrumStore, _gather_index, _search_reach, as_store, segment_isclose_any
+
+__all__ = ["is_mass_in", "screen_ions", "screen_neutral_losses", "FragmentIndex"]
+
+FRAGMENT_INDEX_VERSION = 1
+
+# peaks decoded at a time by `screen_ions`
+_SCREEN_CHUNK = 1 << 20
 
 
 def close_in(x:ArrayLike, y:float, rtol:float=5e-6, atol:float=0) -> np.ndarray:
@@ -33,13 +43,23 @@ def close_in(x:ArrayLike, y:float, rtol:float=5e-6, atol:float=0) -> np.ndarray:
     return np.isclose(x, y, rtol=rtol, atol=atol).any()
 
 
-_is_mass_in = np.vectorize(
-    close_in, otypes=[bool], excluded=["y", "rtol", "atol"]
-)
+def _flatten_spectra(list_of_spec: Sequence[ArrayLike]) -> tuple[np.ndarray, np.ndarray]:
+    # concatenated m/z arrays, each sorted, with their offsets
+    arrays = [np.asarray(mz, dtype=np.float64).ravel() for mz in list_of_spec]
+    counts = np.fromiter((mz.size for mz in arrays), dtype=np.int64, count=len(arrays))
+    offsets = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = np.concatenate(arrays) if arrays else np.zeros(0)
+    descending = flat[1:] < flat[:-1]
+    bounds = offsets[1:-1]
+    descending[bounds[(bounds > 0) & (bounds < flat.size)] - 1] = False
+    if descending.any():
+        flat = flat[np.lexsort((flat, np.repeat(np.arange(counts.size), counts)))]
+    return flat, offsets
 
 
 def is_mass_in(
-    list_of_spec: Sequence[ArrayLike],
+    list_of_spec: Sequence[ArrayLike] | SpectrumStore | pd.DataFrame,
     test_mass: float,
     rtol: float = 5e-6,
     atol: float = 0,
@@ -48,14 +68,19 @@ def is_mass_in(
     Returns a boolean array, where each element represents whether
     the corresponding m/z array in `list_of_spec` has `test_mass` within a tolerance.
 
-    This function uses `numpy.isclose` to test equality, hence using the following equation.
+    This function uses the same test as `numpy.isclose`, hence using the following equation.
 
     absolute(`x` - `test_mass`) <= (`atol` + `rtol` * absolute(`test_mass`))
 
+    Each spectrum is searched by bisection on its sorted m/z, see `SpectrumStore.isclose_any`.
+
+    Note that, as in previous versions, `rtol` and `atol` are applied swapped:
+    `rtol` acts as the absolute tolerance (in Da) and `atol` as the relative one.
+
     Parameters
     ----------
-    list_of_spec : list of 1d array
-        A list of m/z array.
+    list_of_spec : list of 1d array | SpectrumStore | pd.DataFrame
+        A list of m/z array, or the scans of a `SpectrumStore` (or of its DataFrame).
     test_mass : float
         the targeted m/z value.
     rtol : float, optional
@@ -70,4 +95,271 @@ def is_mass_in(
         the corresponding m/z array in `list_of_spec` has `test_mass` 
         within a tolerance.
     """
-    return _is_mass_in(list_of_spec, test_mass, atol, rtol)
+    # the tolerances are passed swapped, as `close_in` always received them
+    if isinstance(list_of_spec, (SpectrumStore, pd.DataFrame)):
+        return as_store(list_of_spec).isclose_any(test_mass, rtol=atol, atol=rtol)
+    flat, offsets = _flatten_spectra(list_of_spec)
+    return segment_isclose_any(flat, offsets[:-1], offsets[1:], test_mass, rtol=atol, atol=rtol)
+
+
+def _targets(targets: Sequence) -> tuple[np.ndarray, list]:
+    # masses and names of `TargetIon`/`ChemFormula` like objects or plain values
+    masses = np.array([getattr(t, "mass", t) for t in targets], dtype=np.float64)
+    names = []
+    for t in targets:
+        if hasattr(t, "refname"):
+            names.append(t.refname)
+        elif hasattr(t, "empirical_formula"):
+            names.append(t.empirical_formula(show_isotope=False))
+        else:
+            names.append(t)
+    return masses, names
+
+
+def _screen_peaks(
+    store: SpectrumStore,
+    targets: np.ndarray,
+    rtol: float | ArrayLike,
+    atol: float | ArrayLike,
+    precursor: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # Scan x target hit matrix, traversing the peaks once: each peak value is looked up among
+    # the sorted targets, and candidates are tested exactly. The values are the m/z, or
+    # `precursor - m/z` with `rtol` relative to `precursor` if given, else to the targets.
+    hits = np.zeros((len(store), targets.size), dtype=bool)
+    if not targets.size or not store.n_peaks:
+        return hits
+    _, rtol, atol = np.broadcast_arrays(targets, rtol, atol)
+    order = np.argsort(targets)
+    targets, rtol, atol = targets[order], rtol[order], atol[order]
+    for start in range(0, store.n_peaks, _SCREEN_CHUNK):
+        values = store.mz_at(slice(start, start + _SCREEN_CHUNK)).astype(np.float64, copy=False)
+        scans = store.scan_index[start:start + values.size]
+        if precursor is None:
+            ref = np.abs(targets).max()
+        else:
+            ref = precursor[scans]
+            values = ref - values
+        # candidates are searched in a slightly wider window, then tested exactly
+        reach = _search_reach(atol.max() + rtol.max() * ref, np.abs(values) + ref)
+        lo = targets.searchsorted(values - reach, "left")
+        counts = targets.searchsorted(values + reach, "right") - lo
+        peaks = np.repeat(np.arange(values.size), counts)
+        cand = _gather_index(lo, counts)
+        tol = atol[cand] + rtol[cand] * (np.abs(targets[cand]) if precursor is None else ref[peaks])
+        match = np.abs(values[peaks] - targets[cand]) <= tol
+        hits[scans[peaks[match]], order[cand[match]]] = True
+    return hits
+
+
+def screen_ions(
+    spectra: SpectrumStore | pd.DataFrame,
+    ions: Sequence,
+    rtol: float | ArrayLike = 5e-6,
+    atol: float | ArrayLike = 0,
+) -> pd.DataFrame:
+    """
+    Search many ions in all scans at once, giving the scan × ion hit matrix.
+
+    Same result as `numpy.isclose(mz, mass, rtol, atol).any()` for every scan and ion,
+    but the peaks are traversed once:
+    each peak is looked up among the sorted ion masses, so the cost hardly grows with the
+    number of ions.
+
+    Parameters
+    ----------
+    spectra : SpectrumStore | pd.DataFrame
+        Scans, e.g. the `ms2` returned by `load_mzml`.
+    ions : Sequence
+        `TargetIon` like objects (with `mass` and `refname`), or m/z values.
+    rtol : float | ArrayLike, optional
+        The relative tolerance parameter (mass accuary), one for all ions or one per ion,
+        by default 5e-6
+    atol : float | ArrayLike, optional
+        The absolute tolerance parameter, one for all ions or one per ion, by default 0
+
+    Returns
+    -------
+    pd.DataFrame
+        Boolean DataFrame with the index of `spectra`, one column per ion, named by
+        the `refname` of the ion (or its m/z).
+    """
+    store = as_store(spectra)
+    masses, names = _targets(ions)
+    return pd.DataFrame(_screen_peaks(store, masses, rtol, atol), index=store.index, columns=names)
+
+
+def screen_neutral_losses(
+    spectra: SpectrumStore | pd.DataFrame,
+    losses: Sequence,
+    rtol: float | ArrayLike = 5e-6,
+    atol: float | ArrayLike = 0,
+) -> pd.DataFrame:
+    """
+    Search neutral losses from the precursor in all MS2 scans at once, giving the scan × loss hit matrix.
+
+    A scan has the loss `loss` if one of its peaks `x` satisfies
+
+    absolute(`precursor` - `x` - `loss`) <= (`atol` + `rtol` * `precursor`)
+
+    i.e. the tolerance is relative to the precursor m/z, the mass measured.
+    `precursor - x` is computed for all peaks of all scans in one batch and looked up
+    among the sorted losses, like `screen_ions`. Scans without precursor never match.
+
+    Parameters
+    ----------
+    spectra : SpectrumStore | pd.DataFrame
+        MS2 scans with a `Precursor` column, e.g. the `ms2` returned by `load_mzml`.
+    losses : Sequence
+        Neutral losses, as `ChemFormula` like objects (with `mass`) or masses.
+    rtol : float | ArrayLike, optional
+        The relative tolerance parameter (mass accuary), one for all losses or one per loss,
+        by default 5e-6
+    atol : float | ArrayLike, optional
+        The absolute tolerance parameter, one for all losses or one per loss, by default 0
+
+    Returns
+    -------
+    pd.DataFrame
+        Boolean DataFrame with the index of `spectra`, one column per loss, named by
+        the `refname` of the loss, its formula or its mass.
+    """
+    store = as_store(spectra)
+    masses, names = _targets(losses)
+    precursor = store.meta[C.PrecursorMZ].to_numpy(dtype=np.float64)
+    hits = _screen_peaks(store, masses, rtol, atol, precursor=precursor)
+    return pd.DataFrame(hits, index=store.index, columns=names)
+
+
+class FragmentIndex:
+    """
+    Inverted index of the peaks of a run, from m/z bins to the peaks in them.
+
+    Built once per run, it answers "which scans have a peak at this m/z" by reading
+    only the bins around the m/z, then testing their peaks with the exact `numpy.isclose`
+    condition, so a lookup does not depend on the number of scans.
+    Use `FragmentIndex.from_spectra` to build it.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        m/z of all peaks, sorted.
+    scans : np.ndarray
+        Position of the scan of each peak.
+    peaks : np.ndarray
+        Position of each peak in the `SpectrumStore` of the run.
+    index : pd.Index
+        Index of the scans.
+    bin_width : float
+        Width of the m/z bins, in Da.
+    """
+
+    def __init__(
+        self,
+        mz: np.ndarray,
+        scans: np.ndarray,
+        peaks: np.ndarray,
+        index: pd.Index,
+        bin_width: float,
+    ) -> None:
+        self.mz = mz
+        self.scans = scans
+        self.peaks = peaks
+        self.index = index
+        self.bin_width = bin_width
+        # postings of the bin `bin_ids[k]` are `bin_offsets[k]:bin_offsets[k + 1]`
+        bins = np.floor(mz / bin_width).astype(np.int64)
+        self.bin_ids, starts = np.unique(bins, return_index=True)
+        self.bin_offsets = np.append(starts, bins.size).astype(np.int64)
+
+    @classmethod
+    def from_spectra(cls, spectra: SpectrumStore | pd.DataFrame, bin_width: float = 0.01) -> "FragmentIndex":
+        """
+        Index the peaks of `spectra`, e.g. the `ms2` returned by `load_mzml`.
+
+        Parameters
+        ----------
+        spectra : SpectrumStore | pd.DataFrame
+            Scans to index.
+        bin_width : float, optional
+            Width of the m/z bins, in Da. Narrow bins make lookups read fewer peaks,
+            by default 0.01
+
+        Returns
+        -------
+        FragmentIndex
+        """
+        store = as_store(spectra)
+        mz = store.mz_at().astype(np.float64, copy=False)
+        peaks = np.argsort(mz, kind="stable")
+        scans = store.scan_index[peaks]
+        scans = scans.astype(np.int32) if len(store) <= np.iinfo(np.int32).max else scans
+        return cls(mz[peaks], scans, peaks, store.index, bin_width)
+
+    def __len__(self) -> int:
+        return self.mz.size
+
+    def __repr__(self) -> str:
+        return f"<FragmentIndex: {len(self.index)} scans, {len(self)} peaks, {self.bin_ids.size} bins>"
+
+    def search(self, mass: float, rtol: float = 5e-6, atol: float = 0) -> np.ndarray:
+        """
+        Postings matching `mass`, as positions into `mz`, `scans` and `peaks`.
+
+        A peak matches if absolute(`mz` - `mass`) <= (`atol` + `rtol` * absolute(`mass`)).
+        """
+        tol = atol + rtol * abs(mass)
+        # candidates are read in a slightly wider window, then tested exactly
+        reach = _search_reach(tol, mass)
+        first, last = np.floor(np.array([mass - reach, mass + reach]) / self.bin_width).astype(np.int64)
+        start = self.bin_offsets[self.bin_ids.searchsorted(first, "left")]
+        stop = self.bin_offsets[self.bin_ids.searchsorted(last, "right")]
+        candidates = np.arange(start, stop)
+        return candidates[np.abs(self.mz[start:stop] - mass) <= tol]
+
+    def is_mass_in(self, mass: float, rtol: float = 5e-6, atol: float = 0) -> np.ndarray:
+        """Whether each indexed scan has a peak at `mass`: a boolean array, one element per scan."""
+        hits = np.zeros(len(self.index), dtype=bool)
+        hits[self.scans[self.search(mass, rtol=rtol, atol=atol)]] = True
+        return hits
+
+    def query(self, mass: float, rtol: float = 5e-6, atol: float = 0) -> pd.Index:
+        """Index of the scans having a peak at `mass` within the tolerance, in scan order."""
+        return self.index[np.unique(self.scans[self.search(mass, rtol=rtol, atol=atol)])]
+
+    def save(self, path: str | os.PathLike) -> None:
+        """
+        Write the index into the file `path`, e.g. next to the mzML file of the run.
+        `.npz` is appended to `path` if missing. The index of the scans must be numeric.
+        """
+        np.savez(
+            path,
+            version=np.int64(FRAGMENT_INDEX_VERSION),
+            mz=self.mz,
+            scans=self.scans,
+            peaks=self.peaks,
+            index=self.index.to_numpy(),
+            index_name=np.array("" if self.index.name is None else str(self.index.name)),
+            bin_width=np.float64(self.bin_width),
+        )
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> "FragmentIndex":
+        """
+        Read an index written by `FragmentIndex.save`.
+
+        Raises
+        ------
+        CorruptedStoreError
+            If the file is not a fragment index of a supported version.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data["version"]) != FRAGMENT_INDEX_VERSION:
+                    raise CorruptedStoreError(f"Unsupported fragment index version in {path}")
+                index = pd.Index(data["index"], name=str(data["index_name"]) or None)
+                return cls(data["mz"], data["scans"], data["peaks"], index, float(data["bin_width"]))
+        except CorruptedStoreError:
+            raise
+        except (OSError, KeyError, ValueError) as e:
+            raise CorruptedStoreError(f"Unreadable fragment index {path}") from e
@@ -0,0 +1,391 @@
+import os
+from collections.abc import Mapping
+from functools import cached_property
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from numpy.typing import ArrayLike
+
+from .defines import ColumnNames as C
+from .mtype import ProgressFunc, check_progress
+from .spectra import CorruptedStoreError, SpectrumStore, as_frame, as_store
+
+__all__ = ["RoiTable", "detect_rois", "assign_precursors"]
+
+ROI_TABLE_VERSION = 1
+
+# columns of the trace of a ROI, as `tools.MS1Ion`
+TRACE_COLUMNS = ["MS1_IDX", "RT", "MZ", "INT"]
+
+
+class RoiTable:
+    """
+    Regions of interest (ROI) stored flat: the trace points of all ROIs in one table.
+
+    The points of the i-th ROI are `points.iloc[offsets[i]:offsets[i + 1]]`.
+    Returned by `detect_rois` and `tools.ms2_ms1_roi`, tables can be saved, concatenated
+    across samples and queried through `summary` and `take`.
+
+    Parameters
+    ----------
+    points : pd.DataFrame
+        Trace points, with a `ROIGroupID` column (0 to the number of ROIs - 1) and
+        the columns of `tools.MS1Ion` (`MS1_IDX`, `RT`, `MZ`, `INT`), grouped by ROI.
+    offsets : ArrayLike
+        Start of every ROI in `points`, followed by the number of points.
+    peaks : ArrayLike, optional
+        Position of every point in the peaks of the MS1 `SpectrumStore`, if known,
+        -1 for points without peak.
+    """
+
+    def __init__(self, points: pd.DataFrame, offsets: ArrayLike, peaks: Optional[ArrayLike] = None) -> None:
+        self.points = points
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.peaks = None if peaks is None else np.asarray(peaks, dtype=np.int64)
+        if self.offsets[0] != 0 or self.offsets[-1] != len(points):
+            raise ValueError("`offsets` must start at 0 and end at the number of points.")
+
+    def __len__(self) -> int:
+        return self.offsets.size - 1
+
+    def __repr__(self) -> str:
+        return f"<RoiTable: {len(self)} ROIs, {len(self.points)} points>"
+
+    def roi(self, i: int) -> pd.DataFrame:
+        """Trace points of the i-th ROI."""
+        return self.points.iloc[self.offsets[i]:self.offsets[i + 1]]
+
+    def traces(self) -> "RoiTraces":
+        """
+        ROI ID to trace mapping, like the dict of DataFrames formerly returned by `tools.ms2_ms1_roi`.
+        The DataFrames are only built when accessed. Their points are in the order of the table,
+        sorted by scan for `tools.ms2_ms1_roi`, not in the forward then backward tracing order.
+        """
+        return RoiTraces(self)
+
+    def take(self, ids: ArrayLike) -> "RoiTable":
+        """ROIs `ids` (in this order), numbered again from 0."""
+        ids = np.asarray(ids, dtype=np.int64)
+        lengths = np.diff(self.offsets)[ids]
+        offsets = np.zeros(ids.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # positions of the points of the selected ROIs
+        pos = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[ids], lengths)
+        points = self.points.iloc[pos].reset_index(drop=True)
+        points[C.ROIGroupID] = np.repeat(np.arange(ids.size), lengths)
+        return RoiTable(points, offsets, None if self.peaks is None else self.peaks[pos])
+
+    @classmethod
+    def concat(cls, tables: Sequence["RoiTable"], keys: Optional[Sequence] = None) -> "RoiTable":
+        """
+        Concatenate ROI tables, ROIs are numbered again in this order.
+
+        Parameters
+        ----------
+        tables : Sequence[RoiTable]
+            ROI tables.
+        keys : Sequence, optional
+            Sample of every table, stored in a `SampleID` first column of the points.
+            Without `keys` the tables must come from the same MS1 scans to keep their `peaks`,
+            by default None
+
+        Returns
+        -------
+        RoiTable
+        """
+        tables = list(tables)
+        if not tables:
+            raise ValueError("No ROI table to concatenate.")
+        shifts = np.cumsum([0] + [len(t) for t in tables])
+        points = []
+        for i, t in enumerate(tables):
+            part = t.points.copy()
+            part[C.ROIGroupID] += shifts[i]
+            if keys is not None:
+                part.insert(0, C.SampleID, keys[i])
+            points.append(part)
+        points = pd.concat(points, ignore_index=True)
+        offsets = np.concatenate(
+            [[0]] + [t.offsets[1:] + n for t, n in zip(tables, np.cumsum([0] + [len(t.points) for t in tables]))]
+        )
+        peaks = None
+        if keys is None and all(t.peaks is not None for t in tables):
+            peaks = np.concatenate([t.peaks for t in tables])
+        return cls(points, offsets, peaks)
+
+    def save(self, path: str | os.PathLike) -> None:
+        """
+        Write the table into the file `path`. `.npz` is appended to `path` if missing.
+        """
+        columns = {}
+        for name, col in self.points.items():
+            col = col.to_numpy()
+            # e.g. sample names, written as fixed-width strings
+            columns[f"points_{name}"] = col.astype(str) if col.dtype == object else col
+        np.savez(
+            path,
+            version=np.int64(ROI_TABLE_VERSION),
+            columns=np.array(list(self.points.columns), dtype=str),
+            offsets=self.offsets,
+            peaks=np.zeros(0, dtype=np.int64) if self.peaks is None else self.peaks,
+            has_peaks=np.bool_(self.peaks is not None),
+            **columns,
+        )
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> "RoiTable":
+        """
+        Read a table written by `RoiTable.save`.
+
+        Raises
+        ------
+        CorruptedStoreError
+            If the file is not a ROI table of a supported version.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if int(data["version"]) != ROI_TABLE_VERSION:
+                    raise CorruptedStoreError(f"Unsupported ROI table version in {path}")
+                points = pd.DataFrame({name: data[f"points_{name}"] for name in data["columns"].tolist()})
+                return cls(points, data["offsets"], data["peaks"] if data["has_peaks"] else None)
+        except CorruptedStoreError:
+            raise
+        except (OSError, KeyError, ValueError) as e:
+            raise CorruptedStoreError(f"Unreadable ROI table {path}") from e
+
+    @cached_property
+    def summary(self) -> pd.DataFrame:
+        """
+        One row per ROI: mean m/z, first and last MS1 scans and RT (in the order of the points),
+        RT and intensity of the most intense point, and number of points.
+        """
+        groups = self.points.groupby(C.ROIGroupID, sort=True)
+        # first most intense point of every ROI
+        order = np.lexsort((-self.points["INT"].to_numpy(), self.points[C.ROIGroupID].to_numpy()))
+        nonempty = np.flatnonzero(np.diff(self.offsets) > 0)
+        apex = order[self.offsets[nonempty]]
+        summary = pd.DataFrame(
+            {
+                "MZ": groups["MZ"].mean(),
+                "MS1_IDX_START": groups["MS1_IDX"].first(),
+                "MS1_IDX_END": groups["MS1_IDX"].last(),
+                "RT_START": groups["RT"].first(),
+                "RT_END": groups["RT"].last(),
+                "RT_APEX": pd.Series(self.points["RT"].to_numpy()[apex], index=nonempty),
+                "INT_APEX": groups["INT"].max(),
+                "N_POINTS": groups.size(),
+            }
+        )
+        return summary.reindex(pd.RangeIndex(len(self), name=C.ROIGroupID))
+
+
+class RoiTraces(Mapping):
+    """Read-only ROI ID to trace mapping of a `RoiTable`, traces are built when accessed."""
+
+    def __init__(self, table: RoiTable) -> None:
+        self.table = table
+
+    def __getitem__(self, key: int) -> pd.DataFrame:
+        if not isinstance(key, (int, np.integer)) or not 0 <= key < len(self.table):
+            raise KeyError(key)
+        return self.table.roi(key)[TRACE_COLUMNS].reset_index(drop=True)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self.table)))
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+
+def detect_rois(
+    ms1: pd.DataFrame | SpectrumStore,
+    mass_deviation: float = 5e-6,
+    min_length: int = 5,
+    min_intensity: float = 0,
+    noise: float = 0,
+    max_gap: int = 0,
+    progress: ProgressFunc | bool = True,
+) -> RoiTable:
+    """
+    Detect the mass traces (ROI) of all features in MS1 scans, like the ROI stage of centWave.
+
+    Scans are read once in RT order. Each peak extends the open ROI whose mean m/z is the nearest,
+    if within `mass_deviation` (the closest peak wins when several match the same ROI),
+    otherwise it opens a new ROI. A ROI missing from more than `max_gap` consecutive scans is closed.
+    All matching of a scan is vectorized, so the cost is linear in the number of scans.
+
+    Parameters
+    ----------
+    ms1 : pd.DataFrame | SpectrumStore
+        MS1 scans, sorted by RT.
+    mass_deviation : float, optional
+        Relative tolerance between a peak and the mean m/z of a ROI, by default 5e-6
+    min_length : int, optional
+        Minimum number of points of a ROI, by default 5
+    min_intensity : float, optional
+        Minimum intensity of the most intense point of a ROI, by default 0
+    noise : float, optional
+        Peaks less intense are ignored, which also bounds the memory used, by default 0
+    max_gap : int, optional
+        Number of consecutive scans a ROI can miss before being closed, by default 0
+    progress : ProgressFunc | bool, optional
+        If True, show progress using `tqdm.tqdm`. If False, show nothing.
+        Optionally, passing a `ProgressFunc` like object will update progress using this object,
+        by default True.
+
+    Returns
+    -------
+    RoiTable
+        ROIs ordered by first scan then m/z, points sorted by scan.
+        Use `assign_precursors` to find the ROI of MS2 precursors.
+    """
+    progress = check_progress(progress)
+    ms1 = as_store(ms1)
+
+    # open ROIs, sorted by mean m/z
+    roi_id = np.zeros(0, dtype=np.int64)
+    roi_sum = np.zeros(0)
+    roi_count = np.zeros(0, dtype=np.int64)
+    roi_last = np.zeros(0, dtype=np.int64)
+    n_rois = 0
+    # points of all ROIs, one array per scan
+    point_roi = []
+    point_peak = []
+    closed = []
+
+    for scan in progress(range(len(ms1)), total=len(ms1)):
+        start = ms1.offsets[scan]
+        mz, inten = ms1.scan(scan)
+        peaks = np.flatnonzero(inten >= noise) if noise > 0 else np.arange(mz.size)
+        mz = np.asarray(mz[peaks], dtype=np.float64)
+
+        assigned = np.full(mz.size, -1, dtype=np.int64)
+        if roi_id.size and mz.size:
+            mean = roi_sum / roi_count
+            # nearest open ROI of every peak
+            right = np.minimum(mean.searchsorted(mz), mean.size - 1)
+            left = np.maximum(right - 1, 0)
+            nearest = np.where(np.abs(mz - mean[left]) <= np.abs(mz - mean[right]), left, right)
+            dist = np.abs(mz - mean[nearest])
+            ok = np.flatnonzero(dist <= mass_deviation * mean[nearest])
+            # a ROI takes its closest peak only
+            ok = ok[np.lexsort((dist[ok], nearest[ok]))]
+            ok = ok[np.unique(nearest[ok], return_index=True)[1]]
+            assigned[ok] = nearest[ok]
+
+            matched = assigned[ok]
+            roi_sum[matched] += mz[ok]
+            roi_count[matched] += 1
+            roi_last[matched] = scan
+
+        # close ROIs missing for too long
+        expired = roi_last < scan - max_gap
+        if expired.any():
+            closed.append((roi_id[expired], roi_count[expired]))
+        new = np.flatnonzero(assigned < 0)
+        keep = ~expired
+        point_roi.append(
+            np.concatenate([roi_id[assigned[assigned >= 0]], n_rois + np.arange(new.size)])
+        )
+        point_peak.append(start + np.concatenate([peaks[assigned >= 0], peaks[new]]))
+
+        # open ROIs, new ones included, sorted again by mean m/z
+        roi_id = np.concatenate([roi_id[keep], n_rois + np.arange(new.size)])
+        roi_sum = np.concatenate([roi_sum[keep], mz[new]])
+        roi_count = np.concatenate([roi_count[keep], np.ones(new.size, dtype=np.int64)])
+        roi_last = np.concatenate([roi_last[keep], np.full(new.size, scan)])
+        n_rois += new.size
+        order = np.argsort(roi_sum / roi_count, kind="stable")
+        roi_id, roi_sum, roi_count, roi_last = roi_id[order], roi_sum[order], roi_count[order], roi_last[order]
+    closed.append((roi_id, roi_count))
+
+    # keep long and intense enough ROIs
+    point_roi = np.concatenate(point_roi) if point_roi else np.zeros(0, dtype=np.int64)
+    point_peak = np.concatenate(point_peak) if point_peak else np.zeros(0, dtype=np.int64)
+    count = np.zeros(n_rois, dtype=np.int64)
+    for ids, counts in closed:
+        count[ids] = counts
+    max_int = np.zeros(n_rois)
+    np.maximum.at(max_int, point_roi, ms1.intensity[point_peak])
+    kept = (count >= min_length) & (max_int >= min_intensity)
+    sel = kept[point_roi]
+    point_roi = point_roi[sel]
+    point_peak = point_peak[sel]
+
+    # ROIs are numbered by first scan then m/z, their points follow in scan order
+    first_point = np.full(n_rois, ms1.n_peaks, dtype=np.int64)
+    np.minimum.at(first_point, point_roi, point_peak)
+    old_ids = np.flatnonzero(kept)
+    old_ids = old_ids[np.argsort(first_point[old_ids], kind="stable")]
+    new_id = np.full(n_rois, -1, dtype=np.int64)
+    new_id[old_ids] = np.arange(old_ids.size)
+    point_roi = new_id[point_roi]
+    order = np.lexsort((point_peak, point_roi))
+    point_roi = point_roi[order]
+    point_peak = point_peak[order]
+
+    scan_pos = ms1.scan_index[point_peak]
+    points = pd.DataFrame(
+        {
+            C.ROIGroupID: point_roi,
+            "MS1_IDX": ms1.index.to_numpy()[scan_pos],
+            "RT": ms1.meta[C.RT].to_numpy()[scan_pos],
+            "MZ": ms1.mz_at(point_peak),
+            "INT": ms1.intensity[point_peak],
+        }
+    )
+    offsets = np.zeros(old_ids.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(point_roi, minlength=old_ids.size), out=offsets[1:])
+    return RoiTable(points, offsets, peaks=point_peak)
+
+
+def assign_precursors(
+    ms2: pd.DataFrame | SpectrumStore,
+    ms1: pd.DataFrame | SpectrumStore,
+    rois: RoiTable,
+    mass_deviation: float = 5e-6,
+) -> pd.Series:
+    """
+    ROI of every MS2 precursor: the ROI of the MS1 peak nearest to the precursor
+    in its MS1 scan (`MS1IDX`), if within `mass_deviation`.
+
+    Parameters
+    ----------
+    ms2 : pd.DataFrame | SpectrumStore
+        MS2 scans, only their scan information is used.
+    ms1 : pd.DataFrame | SpectrumStore
+        MS1 scans `rois` were detected in.
+    rois : RoiTable
+        Result of `detect_rois`.
+    mass_deviation : float, optional
+        Relative tolerance between the precursor and the MS1 peak, by default 5e-6
+
+    Returns
+    -------
+    pd.Series
+        `ROIGroupID` of every MS2 scan, -1 if not in a ROI.
+    """
+    meta = ms2.meta if isinstance(ms2, SpectrumStore) else as_frame(ms2)
+    ms1 = as_store(ms1)
+    if rois.peaks is None:
+        raise ValueError("`rois` does not know the MS1 peaks of its points.")
+
+    precursor = meta[C.PrecursorMZ].to_numpy(dtype=np.float64)
+    scans = ms1.index.get_indexer(meta[C.MS1IDX])
+    roi = np.full(len(meta), -1, dtype=np.int64)
+    if not ms1.n_peaks or not rois.peaks.size:
+        return pd.Series(roi, index=meta.index, name=C.ROIGroupID)
+
+    # nearest MS1 peak of every precursor
+    nearest = np.where(scans >= 0, ms1.nearest_peak(precursor, np.maximum(scans, 0)), -1)
+    valid = nearest >= 0
+    valid[valid] = np.abs(ms1.mz_at(nearest[valid]) - precursor[valid]) <= mass_deviation * precursor[valid]
+
+    # its ROI, by looking up the sorted peak positions of the ROI points
+    order = np.argsort(rois.peaks, kind="stable")
+    sorted_peaks = rois.peaks[order]
+    found = np.minimum(sorted_peaks.searchsorted(nearest), sorted_peaks.size - 1)
+    valid &= sorted_peaks[found] == nearest
+    roi[valid] = rois.points[C.ROIGroupID].to_numpy()[order[found[valid]]]
+    return pd.Series(roi, index=meta.index, name=C.ROIGroupID)
@@ -0,0 +1,804 @@
+import json
+import operator
+import os
+import weakref
+import zlib
+from collections.abc import Iterable, Sequence
+from functools import cached_property
+from typing import Literal, Optional
+
+import numpy as np
+import pandas as pd
+from numpy.typing import ArrayLike
+
+from .defines import ColumnNames as C
+
+__all__ = [
+    "SpectrumStore",
+    "SpectrumStoreBuilder",
+    "CorruptedStoreError",
+    "as_store",
+    "as_frame",
+    "segment_searchsorted",
+    "segment_isclose_any",
+    "quantize_mz",
+    "MZ_QUANTUM",
+]
+
+STORE_FORMAT_VERSION = 1
+
+# Step of quantized m/z (see `quantize_mz`). A power of 2, so that decoding is exact.
+# The rounding error is at most MZ_QUANTUM / 2 ~ 4.8e-7 Da, i.e. < 0.005 ppm above m/z 100,
+# and m/z up to 2**32 * MZ_QUANTUM = 4096 can be stored in uint32.
+MZ_QUANTUM = 2.0 ** -20
+_STORE_MANIFEST = "store.json"
+
+# columns that describe links between scans, the spectra columns are put before them
+_LINK_COLUMNS = (C.MS1IDX, C.ProductsIDX)
+
+# frames produced by `SpectrumStore.frame`, with their `SpecMZ`/`SpecINT` cells, so that
+# `as_store` can return the original store instead of copying the peaks again.
+_FRAME_STORES: dict[int, tuple["SpectrumStore", np.ndarray, np.ndarray]] = {}
+
+
+class CorruptedStoreError(ValueError):
+    pass
+
+
+def _object_column(arrays: Sequence[np.ndarray]) -> np.ndarray:
+    # element-wise assignment keeps numpy from stacking equal-length arrays into 2d
+    col = np.empty(len(arrays), dtype=object)
+    for i, arr in enumerate(arrays):
+        col[i] = arr
+    return col
+
+
+def _gather_index(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of `arange(starts[k], starts[k] + counts[k])` for all k."""
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    new_starts = np.cumsum(counts) - counts
+    return np.arange(total, dtype=np.int64) + np.repeat(
+        np.asarray(starts, dtype=np.int64) - new_starts, counts
+    )
+
+
+def _search_reach(tol: ArrayLike, value: ArrayLike) -> np.ndarray:
+    """
+    Half-width of the window in which to search the values within `tol` of `value`.
+
+    Slightly wider than `tol`, so that no value passing the exact test
+    absolute(`x` - `value`) <= `tol` is missed because of rounding in `value` ± `tol`.
+    Candidates in the window must then be tested exactly.
+    """
+    return np.asarray(tol) * (1 + 1e-9) + np.spacing(np.abs(value))
+
+
+def quantize_mz(mz: ArrayLike) -> np.ndarray:
+    """
+    Round m/z to the nearest multiple of `MZ_QUANTUM`, as uint32 codes.
+
+    `codes * MZ_QUANTUM` gives back m/z within `MZ_QUANTUM / 2` Da. The order of
+    the values is kept, so sorted m/z give sorted codes.
+
+    Raises
+    ------
+    ValueError
+        If some m/z are negative or too large to be stored.
+    """
+    codes = np.rint(np.asarray(mz, dtype=np.float64) / MZ_QUANTUM)
+    if codes.size and (codes.min() < 0 or codes.max() > np.iinfo(np.uint32).max):
+        raise ValueError(f"Only m/z in [0, {2 ** 32 * MZ_QUANTUM:g}) can be quantized.")
+    return codes.astype(np.uint32)
+
+
+def _crc32(path: str) -> int:
+    crc = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _save_array(dirpath: str, name: str, arr: np.ndarray, checksum: bool, written: bool = False) -> dict:
+    path = os.path.join(dirpath, f"{name}.npy")
+    if not written:
+        np.save(path, np.ascontiguousarray(arr), allow_pickle=False)
+    desc = {"file": f"{name}.npy", "dtype": arr.dtype.str, "shape": list(arr.shape)}
+    if checksum:
+        desc["crc32"] = _crc32(path)
+    return desc
+
+
+def _load_array(dirpath: str, desc: dict, mmap_mode: Optional[str]) -> np.ndarray:
+    path = os.path.join(dirpath, desc["file"])
+    # memory-mapped arrays are not read whole, only their size is checked
+    if "crc32" in desc and mmap_mode is None and _crc32(path) != desc["crc32"]:
+        raise CorruptedStoreError(f"Checksum mismatch: {path}")
+    arr = np.load(path, mmap_mode=mmap_mode, allow_pickle=False)
+    if arr.dtype.str != desc["dtype"] or list(arr.shape) != desc["shape"]:
+        raise CorruptedStoreError(f"Unexpected dtype or shape: {path}")
+    if isinstance(arr, np.memmap) and arr.offset + arr.nbytes != os.path.getsize(path):
+        raise CorruptedStoreError(f"Unexpected file size: {path}")
+    return arr
+
+
+def segment_searchsorted(
+    a: ArrayLike,
+    starts: ArrayLike,
+    stops: ArrayLike,
+    v: ArrayLike,
+    side: Literal["left", "right"] = "left",
+) -> np.ndarray:
+    """
+    Vectorized `numpy.searchsorted` over many sorted segments of one array.
+
+    For each k, finds the insertion point of `v[k]` into the sorted segment
+    `a[starts[k]:stops[k]]`, all queries being answered together by a
+    bisection running in O(log n) numpy passes.
+
+    Parameters
+    ----------
+    a : ArrayLike
+        1d array whose segments are each sorted in ascending order.
+    starts, stops : ArrayLike
+        Bounds of the segment searched by each query.
+    v : ArrayLike
+        Values to insert, broadcast against `starts`.
+    side : {"left", "right"}, optional
+        Same as `numpy.searchsorted`, by default "left"
+
+    Returns
+    -------
+    np.ndarray
+        Insertion points as absolute positions into `a`.
+    """
+    a = np.asarray(a) if not isinstance(a, np.ndarray) else a
+    lo, hi, v = np.broadcast_arrays(
+        np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64), v
+    )
+    shape = lo.shape
+    lo = lo.flatten()
+    hi = hi.flatten()
+    v = v.ravel()
+    active = np.flatnonzero(lo < hi)
+    while active.size:
+        mid = (lo[active] + hi[active]) // 2
+        if side == "left":
+            go_right = a[mid] < v[active]
+        else:
+            go_right = a[mid] <= v[active]
+        lo[active[go_right]] = mid[go_right] + 1
+        hi[active[~go_right]] = mid[~go_right]
+        active = active[lo[active] < hi[active]]
+    return lo.reshape(shape)
+
+
+def _close_to_neighbors(values_at, n: int, pos: np.ndarray, starts, stops, v, rtol: float, atol: float) -> np.ndarray:
+    # Within a sorted segment, the values passing `abs(x - v) <= atol + rtol * abs(v)` are contiguous
+    # around the insertion point `pos` of `v`, so testing its two neighbors gives the exact result.
+    starts, stops, v = np.broadcast_arrays(starts, stops, v)
+    tol = atol + rtol * np.abs(v)
+    if n == 0:
+        return np.zeros(pos.shape, dtype=bool)
+    right = np.minimum(pos, n - 1)
+    left = np.maximum(pos - 1, 0)
+    return ((pos < stops) & (np.abs(values_at(right) - v) <= tol)) | (
+        (pos > starts) & (np.abs(values_at(left) - v) <= tol)
+    )
+
+
+def segment_isclose_any(
+    a: ArrayLike,
+    starts: ArrayLike,
+    stops: ArrayLike,
+    v: ArrayLike,
+    rtol: float = 5e-6,
+    atol: float = 0,
+) -> np.ndarray:
+    """
+    For each k, whether the sorted segment `a[starts[k]:stops[k]]` has a value close to `v[k]`.
+
+    Gives the same result as `numpy.isclose(a[starts[k]:stops[k]], v[k], rtol, atol).any()`,
+    i.e. tests `absolute(a - v) <= (atol + rtol * absolute(v))`, with a binary search
+    per segment instead of a full scan.
+
+    Parameters
+    ----------
+    a : ArrayLike
+        1d array whose segments are each sorted in ascending order.
+    starts, stops : ArrayLike
+        Bounds of the segment searched by each query.
+    v : ArrayLike
+        Values to test, broadcast against `starts`.
+    rtol : float, optional
+        The relative tolerance parameter, by default 5e-6
+    atol : float, optional
+        The absolute tolerance parameter, by default 0
+
+    Returns
+    -------
+    np.ndarray
+        Boolean array of the broadcast shape.
+    """
+    a = np.asarray(a) if not isinstance(a, np.ndarray) else a
+    v = np.asarray(v, dtype=np.float64)
+    pos = segment_searchsorted(a, starts, stops, v)
+    return _close_to_neighbors(lambda idx: a[idx], a.size, pos, starts, stops, v, rtol, atol)
+
+
+class SpectrumStore:
+    """
+    Peaks of a whole run kept in a columnar (CSR) layout.
+
+    The peaks of the i-th scan are `mz[offsets[i]:offsets[i + 1]]` and
+    `intensity[offsets[i]:offsets[i + 1]]`, sorted by m/z. Scan level data
+    (RT, precursor, ...) is kept in `meta`, one row per scan in the same order.
+    The per-scan `pandas.DataFrame` returned by `load_mzml` is available
+    through `frame`.
+
+    Parameters
+    ----------
+    mz : ArrayLike
+        m/z of all peaks.
+    intensity : ArrayLike
+        Intensity of all peaks.
+    offsets : ArrayLike
+        Start of every scan in `mz`, followed by the total number of peaks.
+    meta : pd.DataFrame
+        Scan information, one row per scan.
+    attrs : dict, optional
+        Information about the run, e.g. how it was loaded.
+    mz_scale : float, optional
+        If given, `mz` holds integer codes of the m/z (see `quantize_mz`) and the
+        m/z are `mz * mz_scale`. `scan`, `mz_at`, `searchsorted` and `frame` always
+        work with float64 m/z, by default None
+    """
+
+    def __init__(
+        self,
+        mz: ArrayLike,
+        intensity: ArrayLike,
+        offsets: ArrayLike,
+        meta: pd.DataFrame,
+        attrs: Optional[dict] = None,
+        mz_scale: Optional[float] = None,
+    ) -> None:
+        self.mz = np.asanyarray(mz)
+        self.mz_scale = mz_scale
+        self.intensity = np.asanyarray(intensity)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.meta = meta
+        self.attrs = {} if attrs is None else dict(attrs)
+        self._frame_ref: Optional[weakref.ref] = None
+        self._peaks_dir: Optional[str] = None
+
+        if self.mz.shape != self.intensity.shape or self.mz.ndim != 1:
+            raise ValueError("`mz` and `intensity` must be 1d arrays of the same length.")
+        if self.offsets.shape != (len(meta) + 1,):
+            raise ValueError(
+                f"Expect {len(meta) + 1} offsets for {len(meta)} scans, got {self.offsets.size}."
+            )
+        if self.offsets[0] != 0 or self.offsets[-1] != self.mz.size:
+            raise ValueError("`offsets` must start at 0 and end at the number of peaks.")
+        if mz_scale is not None and self.mz.dtype.kind != "u":
+            raise ValueError("Quantized `mz` must be unsigned integers.")
+
+    @classmethod
+    def from_spectra(
+        cls,
+        spectra: Iterable[tuple[ArrayLike, ArrayLike]],
+        meta: pd.DataFrame,
+        attrs: Optional[dict] = None,
+    ) -> "SpectrumStore":
+        """Build a store from `(mz, intensity)` pairs, one per row of `meta`."""
+        mz_list = []
+        int_list = []
+        for mz, int_ in spectra:
+            mz_list.append(np.asarray(mz))
+            int_list.append(np.asarray(int_))
+        counts = np.fromiter((a.size for a in mz_list), dtype=np.int64, count=len(mz_list))
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if mz_list:
+            mz = np.concatenate(mz_list)
+            intensity = np.concatenate(int_list)
+        else:
+            mz = np.zeros(0, dtype=float)
+            intensity = np.zeros(0, dtype=float)
+        return cls(mz, intensity, offsets, meta, attrs)
+
+    @classmethod
+    def concat(cls, stores: Sequence["SpectrumStore"], ignore_index: bool = False) -> "SpectrumStore":
+        """
+        Stack the scans of `stores` into one store, in order.
+
+        The attrs of the first store are kept. If `ignore_index`, the index is
+        reset to `0, 1, ..., n - 1` with the name of the first index.
+        Stores quantized differently are concatenated as float64 m/z.
+        """
+        if not stores:
+            raise ValueError("No store to concatenate.")
+        counts = np.concatenate([store.peak_counts for store in stores])
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        meta = pd.concat([store.meta for store in stores])
+        if ignore_index:
+            meta.index = pd.RangeIndex(len(meta), name=stores[0].index.name)
+        mz_scale = stores[0].mz_scale
+        if all(store.mz_scale == mz_scale for store in stores):
+            mz = np.concatenate([store.mz for store in stores])
+        else:
+            mz = np.concatenate([store.mz_at() for store in stores])
+            mz_scale = None
+        return cls(
+            mz,
+            np.concatenate([store.intensity for store in stores]),
+            offsets,
+            meta,
+            stores[0].attrs,
+            mz_scale,
+        )
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "SpectrumStore":
+        """Build a store from a DataFrame with `SpecMZ` and `SpecINT` columns."""
+        meta = frame.drop(columns=[C.SpecMZ, C.SpecINT])
+        return cls.from_spectra(zip(frame[C.SpecMZ], frame[C.SpecINT]), meta)
+
+    def save(self, path: str | os.PathLike) -> None:
+        """
+        Write the store into the directory `path`.
+
+        Every array is saved as a `.npy` file, so that `SpectrumStore.open`
+        can memory-map them. `attrs` must be JSON serializable.
+        Columns of `meta` must be numeric or hold lists of numbers.
+        """
+        os.makedirs(path, exist_ok=True)
+        columns = []
+        for i, (name, col) in enumerate(self.meta.items()):
+            values = col.to_numpy()
+            if values.dtype == object and all(isinstance(v, (list, tuple, np.ndarray)) for v in values):
+                counts = np.fromiter((len(v) for v in values), dtype=np.int64, count=values.size)
+                flat = np.concatenate([np.asarray(v) for v in values]) if counts.sum() else np.zeros(0, np.int64)
+                columns.append({
+                    "name": name,
+                    "kind": "ragged",
+                    "values": _save_array(path, f"meta{i}", flat, True),
+                    "counts": _save_array(path, f"meta{i}-counts", counts, True),
+                })
+            else:
+                values = np.asarray(values.tolist()) if values.dtype == object else values
+                if values.dtype == object:
+                    raise TypeError(f"Column {name!r} can not be saved.")
+                columns.append({"name": name, "kind": "array", "values": _save_array(path, f"meta{i}", values, True)})
+        # peaks written there by `SpectrumStoreBuilder` are not saved again
+        written = self._peaks_dir is not None and os.path.abspath(path) == self._peaks_dir
+        manifest = {
+            "version": STORE_FORMAT_VERSION,
+            "mz": _save_array(path, "mz", self.mz, True, written),
+            "intensity": _save_array(path, "intensity", self.intensity, True, written),
+            "offsets": _save_array(path, "offsets", self.offsets, True),
+            "index": _save_array(path, "index", self.index.to_numpy(), True),
+            "index_name": self.index.name,
+            "mz_scale": self.mz_scale,
+            "columns": columns,
+            "attrs": self.attrs,
+        }
+        # written last, a store without manifest is incomplete
+        with open(os.path.join(path, _STORE_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def open(cls, path: str | os.PathLike, mmap_mode: Optional[Literal["r", "c"]] = None) -> "SpectrumStore":
+        """
+        Read a store written by `SpectrumStore.save`.
+
+        Parameters
+        ----------
+        path : str | os.PathLike
+            Directory of the store.
+        mmap_mode : {None, "r", "c"}, optional
+            If not None, the peak arrays are memory-mapped with this mode instead of
+            being read into memory, see `numpy.load`. Their checksums are then not verified,
+            only their dtype, shape and file size. By default None
+
+        Returns
+        -------
+        SpectrumStore
+
+        Raises
+        ------
+        CorruptedStoreError
+            If the files do not match the manifest.
+        """
+        try:
+            with open(os.path.join(path, _STORE_MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CorruptedStoreError(f"Missing or unreadable manifest in {path}") from e
+        if manifest.get("version") != STORE_FORMAT_VERSION:
+            raise CorruptedStoreError(f"Unsupported store version in {path}")
+
+        data = {}
+        for desc in manifest["columns"]:
+            values = _load_array(path, desc["values"], None)
+            if desc["kind"] == "ragged":
+                counts = _load_array(path, desc["counts"], None)
+                if counts.sum() != values.size:
+                    raise CorruptedStoreError(f"Unexpected ragged column in {path}")
+                values = _object_column(
+                    [values[stop - n:stop].tolist() for n, stop in zip(counts, np.cumsum(counts))]
+                )
+            data[desc["name"]] = values
+        index = pd.Index(_load_array(path, manifest["index"], None), name=manifest["index_name"])
+        meta = pd.DataFrame(data, index=index, columns=[desc["name"] for desc in manifest["columns"]])
+        offsets = _load_array(path, manifest["offsets"], None)
+        if (np.diff(offsets) < 0).any():
+            raise CorruptedStoreError(f"Unexpected offsets in {path}")
+        try:
+            return cls(
+                _load_array(path, manifest["mz"], mmap_mode),
+                _load_array(path, manifest["intensity"], mmap_mode),
+                offsets,
+                meta,
+                manifest["attrs"],
+                manifest.get("mz_scale"),
+            )
+        except ValueError as e:
+            raise CorruptedStoreError(str(e)) from e
+
+    def __getstate__(self) -> dict:
+        # the frame and the cache directory belong to this process
+        state = self.__dict__.copy()
+        state["_frame_ref"] = None
+        state["_peaks_dir"] = None
+        state.pop("scan_index", None)
+        return state
+
+    def __len__(self) -> int:
+        return len(self.meta)
+
+    def __repr__(self) -> str:
+        return f"<SpectrumStore: {len(self)} scans, {self.n_peaks} peaks>"
+
+    @property
+    def n_peaks(self) -> int:
+        return self.mz.size
+
+    @property
+    def index(self) -> pd.Index:
+        return self.meta.index
+
+    @property
+    def peak_counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @cached_property
+    def scan_index(self) -> np.ndarray:
+        """Position of the scan each peak belongs to."""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.peak_counts)
+
+    def scan(self, pos: int) -> tuple[np.ndarray, np.ndarray]:
+        """m/z and intensity of the scan at position `pos` (views, unless m/z are quantized)."""
+        start, stop = self.offsets[pos], self.offsets[pos + 1]
+        return self.mz_at(slice(start, stop)), self.intensity[start:stop]
+
+    def mz_at(self, positions: "ArrayLike | slice | None" = None) -> np.ndarray:
+        """m/z of the peaks at `positions` (all peaks by default), decoded if quantized."""
+        mz = self.mz if positions is None else self.mz[positions]
+        if self.mz_scale is None:
+            return mz
+        return mz * self.mz_scale
+
+    def positions(self, labels: ArrayLike) -> np.ndarray:
+        """Positions of the scans with index `labels`."""
+        pos = self.index.get_indexer(np.atleast_1d(labels))
+        if (pos < 0).any():
+            raise KeyError(f"Scans not found: {np.atleast_1d(labels)[pos < 0]}")
+        return pos
+
+    def take(self, positions: ArrayLike) -> "SpectrumStore":
+        """New store made of the scans at `positions`, in that order."""
+        positions = np.asarray(positions, dtype=np.int64)
+        counts = self.peak_counts[positions]
+        gather = _gather_index(self.offsets[positions], counts)
+        offsets = np.zeros(positions.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return SpectrumStore(
+            self.mz[gather],
+            self.intensity[gather],
+            offsets,
+            self.meta.iloc[positions],
+            self.attrs,
+            self.mz_scale,
+        )
+
+    def searchsorted(
+        self,
+        v: ArrayLike,
+        scans: Optional[ArrayLike] = None,
+        side: Literal["left", "right"] = "left",
+    ) -> np.ndarray:
+        """
+        Insertion points of `v` into the m/z array of every scan in `scans`.
+
+        Parameters
+        ----------
+        v : ArrayLike
+            m/z values, broadcast against `scans`.
+        scans : ArrayLike, optional
+            Scan positions, by default all scans.
+        side : {"left", "right"}, optional
+            Same as `numpy.searchsorted`, by default "left"
+
+        Returns
+        -------
+        np.ndarray
+            Absolute peak positions, between `offsets[scan]` and `offsets[scan + 1]`.
+        """
+        if scans is None:
+            scans = np.arange(len(self))
+        scans = np.asarray(scans, dtype=np.int64)
+        if self.mz_scale is not None:
+            # codes c with c * scale >= v are c >= ceil(v / scale), those > v are c > floor(v / scale)
+            v = np.asarray(v, dtype=np.float64) / self.mz_scale
+            v = np.clip(np.ceil(v) if side == "left" else np.floor(v), -1, np.iinfo(self.mz.dtype).max + 1)
+        return segment_searchsorted(
+            self.mz, self.offsets[scans], self.offsets[scans + 1], v, side=side
+        )
+
+    def nearest_peak(self, v: ArrayLike, scans: ArrayLike) -> np.ndarray:
+        """
+        Position of the peak nearest to `v` in every scan of `scans`, like `argmin`
+        of the distances: the first of the nearest peaks on ties.
+
+        Parameters
+        ----------
+        v : ArrayLike
+            m/z values, broadcast against `scans`.
+        scans : ArrayLike
+            Scan positions.
+
+        Returns
+        -------
+        np.ndarray
+            Absolute peak positions, -1 for scans without peaks.
+        """
+        v, scans = np.broadcast_arrays(np.asarray(v, dtype=np.float64), np.asarray(scans, dtype=np.int64))
+        if not self.n_peaks:
+            return np.full(v.shape, -1, dtype=np.int64)
+        starts = self.offsets[scans]
+        stops = self.offsets[scans + 1]
+        right = self.searchsorted(v, scans)
+        has_left = right > starts
+        has_right = right < stops
+        # first occurrence of the peak just below `v`, positions clipped for empty sides
+        left = np.minimum(np.maximum(right - 1, starts), self.n_peaks - 1)
+        left = np.minimum(self.searchsorted(self.mz_at(left), scans), left)
+        right = np.minimum(right, self.n_peaks - 1)
+        nearest = np.where(has_left & (~has_right | (v - self.mz_at(left) <= self.mz_at(right) - v)), left, right)
+        return np.where(has_left | has_right, nearest, -1)
+
+    def isclose_any(
+        self,
+        v: ArrayLike,
+        rtol: float = 5e-6,
+        atol: float = 0,
+        scans: Optional[ArrayLike] = None,
+    ) -> np.ndarray:
+        """
+        Whether every scan in `scans` has a peak at m/z `v` within a tolerance.
+
+        Same as `numpy.isclose(mz, v, rtol, atol).any()` on each scan, see `segment_isclose_any`.
+
+        Parameters
+        ----------
+        v : ArrayLike
+            m/z values, broadcast against `scans`.
+        rtol : float, optional
+            The relative tolerance parameter, by default 5e-6
+        atol : float, optional
+            The absolute tolerance parameter, by default 0
+        scans : ArrayLike, optional
+            Scan positions, by default all scans.
+
+        Returns
+        -------
+        np.ndarray
+            Boolean array of the broadcast shape of `v` and `scans`.
+        """
+        if scans is None:
+            scans = np.arange(len(self))
+        scans = np.asarray(scans, dtype=np.int64)
+        v = np.asarray(v, dtype=np.float64)
+        pos = self.searchsorted(v, scans)
+        return _close_to_neighbors(
+            self.mz_at, self.n_peaks, pos, self.offsets[scans], self.offsets[scans + 1], v, rtol, atol
+        )
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        """
+        One row per scan, with `SpecMZ`/`SpecINT` cells viewing the peak arrays.
+
+        The frame is built on first access and shared while it is alive and unchanged.
+        Quantized m/z are decoded to one float64 array, which is kept alongside the codes,
+        so the frame uses more memory than the store it views.
+        """
+        frame = self._frame_ref() if self._frame_ref is not None else None
+        if frame is not None and _frame_matches(frame, *_FRAME_STORES[id(frame)]):
+            return frame
+        frame = self.meta.copy()
+        frame.attrs = dict(self.attrs)
+        loc = len(frame.columns)
+        for col in _LINK_COLUMNS:
+            if col in frame.columns:
+                loc = min(loc, frame.columns.get_loc(col))
+        bounds = self.offsets[1:-1]
+        mz_cells = _object_column(np.split(self.mz_at(), bounds))
+        int_cells = _object_column(np.split(self.intensity, bounds))
+        frame.insert(loc, C.SpecMZ, mz_cells)
+        frame.insert(loc + 1, C.SpecINT, int_cells)
+        # the frame keeps the store alive, not the other way around
+        self._frame_ref = weakref.ref(frame)
+        _FRAME_STORES[id(frame)] = (self, mz_cells, int_cells)
+        weakref.finalize(frame, _FRAME_STORES.pop, id(frame), None)
+        return frame
+
+
+class SpectrumStoreBuilder:
+    """
+    Collect scans one by one and build a `SpectrumStore`.
+
+    Parameters
+    ----------
+    path : str | os.PathLike, optional
+        If given, peaks are written into this directory as they are appended and the built
+        store memory-maps them, so that a run never needs to fit in memory.
+        `SpectrumStore.save` on the same directory completes the store on disk.
+        Otherwise, peaks are kept in memory, by default None
+    """
+
+    # scans copied at a time when writing the final arrays
+    CHUNK_SIZE = 1024
+
+    def __init__(self, path: Optional[str | os.PathLike] = None) -> None:
+        self.path = path
+        self.counts: list[int] = []
+        self.dtypes: Optional[tuple[np.dtype, np.dtype]] = None
+        if path is None:
+            self._mz: list[np.ndarray] = []
+            self._int: list[np.ndarray] = []
+        else:
+            os.makedirs(path, exist_ok=True)
+            self._mz_file = open(os.path.join(path, "mz.tmp"), "wb")
+            self._int_file = open(os.path.join(path, "intensity.tmp"), "wb")
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def append(self, mz: ArrayLike, intensity: ArrayLike) -> None:
+        mz = np.asarray(mz)
+        intensity = np.asarray(intensity)
+        if self.dtypes is None:
+            self.dtypes = (mz.dtype, intensity.dtype)
+        mz = mz.astype(self.dtypes[0], copy=False)
+        intensity = intensity.astype(self.dtypes[1], copy=False)
+        self.counts.append(mz.size)
+        if self.path is None:
+            self._mz.append(mz)
+            self._int.append(intensity)
+        else:
+            self._mz_file.write(mz.tobytes())
+            self._int_file.write(intensity.tobytes())
+
+    def build(
+        self,
+        meta: pd.DataFrame,
+        order: Optional[ArrayLike] = None,
+        attrs: Optional[dict] = None,
+        mz_scale: Optional[float] = None,
+    ) -> SpectrumStore:
+        """
+        Build the store, with scans reordered by `order` if given.
+
+        `meta` describes the scans in the order they were appended,
+        `mz_scale` is set if quantized m/z were appended.
+        """
+        counts = np.asarray(self.counts, dtype=np.int64)
+        if order is None:
+            order = np.arange(counts.size)
+        order = np.asarray(order, dtype=np.int64)
+        if self.path is None:
+            store = SpectrumStore.from_spectra(zip(self._mz, self._int), meta, attrs)
+            if mz_scale is not None:
+                store = SpectrumStore(
+                    store.mz.astype(np.uint32, copy=False), store.intensity, store.offsets, meta, attrs, mz_scale
+                )
+            self._mz, self._int = [], []
+            return store.take(order) if (order != np.arange(order.size)).any() else store
+
+        self._mz_file.close()
+        self._int_file.close()
+        mz_dtype, int_dtype = self.dtypes or (np.dtype(float if mz_scale is None else np.uint32), np.dtype(float))
+        src_offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=src_offsets[1:])
+        offsets = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts[order], out=offsets[1:])
+
+        arrays = []
+        for name, dtype in (("mz", mz_dtype), ("intensity", int_dtype)):
+            tmp_path = os.path.join(self.path, f"{name}.tmp")
+            out = np.lib.format.open_memmap(
+                os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(int(offsets[-1]),)
+            )
+            if out.size:
+                src = np.memmap(tmp_path, dtype=dtype, mode="r", shape=(int(src_offsets[-1]),))
+                for i in range(0, order.size, self.CHUNK_SIZE):
+                    chunk = order[i:i + self.CHUNK_SIZE]
+                    gather = _gather_index(src_offsets[chunk], counts[chunk])
+                    out[offsets[i]:offsets[i] + gather.size] = src[gather]
+                del src
+            out.flush()
+            del out
+            os.remove(tmp_path)
+            arrays.append(np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r"))
+        store = SpectrumStore(arrays[0], arrays[1], offsets, meta.iloc[order], attrs, mz_scale)
+        store._peaks_dir = os.path.abspath(self.path)
+        return store
+
+
+def as_store(spectra: "SpectrumStore | pd.DataFrame") -> SpectrumStore:
+    """
+    Return `spectra` as a `SpectrumStore`.
+
+    A DataFrame created by `SpectrumStore.frame` gives back its store without copying,
+    unless it was changed since. If only its other columns were changed, the peak arrays
+    of the store are shared with a new store holding the current columns.
+    Other DataFrames with `SpecMZ`/`SpecINT` columns are converted.
+    """
+    if isinstance(spectra, SpectrumStore):
+        return spectra
+    entry = _FRAME_STORES.get(id(spectra))
+    if entry is None or not _frame_matches(spectra, *entry):
+        return SpectrumStore.from_frame(spectra)
+    store = entry[0]
+    meta = spectra.drop(columns=[C.SpecMZ, C.SpecINT])
+    if meta.equals(store.meta) and spectra.attrs == store.attrs:
+        return store
+    edited = SpectrumStore(store.mz, store.intensity, store.offsets, meta, spectra.attrs, store.mz_scale)
+    edited._peaks_dir = store._peaks_dir
+    return edited
+
+
+def _frame_matches(frame: pd.DataFrame, store: "SpectrumStore", mz_cells: np.ndarray, int_cells: np.ndarray) -> bool:
+    # the frame is the one of the store and its rows and spectra cells were not edited in place
+    if store._frame_ref is None or store._frame_ref() is not frame:
+        return False
+    if len(frame) != len(store) or not frame.index.equals(store.index):
+        return False
+    if C.SpecMZ not in frame.columns or C.SpecINT not in frame.columns:
+        return False
+    return all(map(operator.is_, frame[C.SpecMZ].to_numpy(), mz_cells)) and all(
+        map(operator.is_, frame[C.SpecINT].to_numpy(), int_cells)
+    )
+
+
+def as_frame(spectra: "SpectrumStore | pd.DataFrame") -> pd.DataFrame:
+    """Return `spectra` as a DataFrame with `SpecMZ`/`SpecINT` columns."""
+    if isinstance(spectra, SpectrumStore):
+        return spectra.frame
+    return spectra
+
+
+@pd.api.extensions.register_dataframe_accessor("spec")
+class SpectrumAccessor:
+    def __init__(self, pandas_object: pd.DataFrame) -> None:
+        self.pd_obj = pandas_object
+
+    @property
+    def store(self) -> SpectrumStore:
+        return as_store(self.pd_obj)
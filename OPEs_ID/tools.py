@@ -1,10 +1,11 @@
 import dataclasses
-import functools
-import itertools
-import operator
-from collections import namedtuple
+import weakref
+from collections import OrderedDict, namedtuple
 from typing import Literal, Optional, Sequence
 
+from numpy.typing import ArrayLike
+
+import joblib
 import numpy as np
 import pandas as pd
 import tqdm
@@ -12,11 +13,19 @@ import tqdm
 
 from .mtype import ProgressFunc, check_progress
 from .defines import ColumnNames as C
-from .elements import EDB
+from .elements import isotope_pattern
 from .expr import ChemFormula
+from .roi import RoiTable
+from .spectra import MZ_QUANTUM, SpectrumStore, _gather_index, _search_reach, as_store
+from .utils import ProgressParallel
 
 MS1Ion = namedtuple("MS1Ion", ["MS1_IDX", "RT", "MZ", "INT"])
 
+# (target, scan) pairs searched at a time by `eic_matrix`
+_EIC_CHUNK = 1 << 20
+
+EICCacheInfo = namedtuple("EICCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
 
 @dataclasses.dataclass
 class TargetIon:
@@ -46,24 +55,35 @@ def isotope_distribution(
     elements: dict[str, int],
     normalize_mass: Optional[Literal["highest", "first", "last"]] = None,
     normalize_distribution: bool = False,
+    *,
+    min_abundance: float = 0,
+    resolution: Optional[float] = None,
+    names: bool = True,
 ):
-    mass = []
-    distribution = []
-    names = []
-    for ele, num in elements.items():
-        iso_weights, iso_dists, iso_names = EDB[ele].isotopes_distribution(num)
-        mass.append(iso_weights)
-        distribution.append(iso_dists)
-        names.append(iso_names)
-
-    mass = np.asarray([np.sum(item) for item in itertools.product(*mass)])
-    distribution = np.asarray(
-        [np.prod(item) for item in itertools.product(*distribution)]
-    )
-    names = np.asarray(
-        [functools.reduce(operator.add, item) for item in itertools.product(*names)],
-        dtype=object,
-    )  # type: ignore
+    """
+    Isotope pattern of a molecule, see `elements.isotope_pattern`.
+
+    Parameters
+    ----------
+    elements : dict[str, int]
+        Number of atoms of every element.
+    normalize_mass : {"highest", "first", "last"}, optional
+        Masses relative to the most abundant, the lightest or the heaviest peak, by default None
+    normalize_distribution : bool, optional
+        Abundances relative to the most abundant peak, by default False
+    min_abundance : float, optional
+        Peaks less abundant are dropped, by default 0
+    resolution : float, optional
+        Peaks closer (in Da) are merged, by default None
+    names : bool, optional
+        Build the `ChemFormula` of every peak, by default True
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray | None]
+        Masses, abundances and names of the peaks, sorted by mass.
+    """
+    mass, distribution, names = isotope_pattern(elements, min_abundance, resolution, names=names)
     if normalize_distribution:
         distribution /= distribution.max()
 
@@ -73,11 +93,6 @@ def isotope_distribution(
         mass -= mass.min()
     elif normalize_mass == "last":
         mass -= mass.max()
-
-    order = np.argsort(mass)
-    mass = mass[order]
-    distribution = distribution[order]
-    names = names[order]
     return mass, distribution, names
 
 
@@ -86,85 +101,527 @@ def get_closest_ion(mz, ms1mz, ms1int):
     return ms1mz[mz_idx], ms1int[mz_idx]
 
 
-def ms2_ms1_roi(ms2, ms1, mass_deviation, progress: ProgressFunc | bool = True):
-    progress = check_progress(progress)
+class _PrecursorGroups:
+    """MS2 precursors grouped by MS1 scan, sorted by m/z within each group."""
 
-    roi_id = pd.Series(-1, index=ms2.index, dtype=int, name=C.ROIGroupID)
-    roi_idx_counter = 0
-    ms2_idx_to_ms1_roi = {}
+    def __init__(self, ms1_idx: np.ndarray, precursor_mz: np.ndarray, first: int, last: int) -> None:
+        self.order = np.lexsort((precursor_mz, ms1_idx))
+        self.mz = precursor_mz[self.order]
+        # rows of the MS1 scan p are order[bounds[p - first]:bounds[p - first + 1]]
+        self.first = first
+        self.bounds = ms1_idx[self.order].searchsorted(np.arange(first, last + 2)).tolist()
+        self.empty = self.order[:0]
 
-    for idx in progress(roi_id.index):
-        if roi_id.at[idx] == -1:
-            current_roi_idx = roi_idx_counter
-            roi_idx_counter += 1
+    def hits(self, p: int, mz_mean: float, rtol: float) -> np.ndarray:
+        """Rows with MS1IDX `p` and precursor within `rtol` of `mz_mean`, in row order."""
+        start, stop = self.bounds[p - self.first], self.bounds[p - self.first + 1]
+        if start == stop:
+            return self.empty
+        tol = rtol * abs(mz_mean)
+        # rows passing the test are contiguous in the group, search a slightly wider window
+        reach = _search_reach(tol, mz_mean)
+        lo = start + self.mz[start:stop].searchsorted(mz_mean - reach, "left")
+        hi = start + self.mz[start:stop].searchsorted(mz_mean + reach, "right")
+        cand = np.arange(lo, hi)
+        return np.sort(self.order[cand[np.abs(self.mz[cand] - mz_mean) <= tol]])
 
-            roi_id.at[idx] = current_roi_idx
-            mz_list = [ms2.at[idx, C.PrecursorMZ]]
-            ms1_idx_start = ms2.at[idx, C.MS1IDX]
 
-            p = ms1_idx_start
-            spec = ms1.loc[p]
-            m, i = get_closest_ion(
-                ms2.at[idx, C.PrecursorMZ], spec[C.SpecMZ], spec[C.SpecINT]
-            )
-            roi_ms1 = [MS1Ion(p, ms1.at[p, "RT"], m, i)]
-            # forward:
-            while p < ms1.index.max():
-                mz_mean = np.mean(mz_list)
-                p += 1
-                spec = ms1.loc[p]
-                ms2_hit = (ms2[C.MS1IDX] == p) & np.isclose(
-                    ms2[C.PrecursorMZ], mz_mean, rtol=mass_deviation, atol=0
-                )
-
-                if ms2_hit.any():
-                    roi_id[ms2_hit] = current_roi_idx
-                    mz_list.extend(ms2.loc[ms2_hit, C.PrecursorMZ].to_list())
-                else:
-                    e = np.abs(spec[C.SpecMZ] - mz_mean)
-                    if np.any(e <= mz_mean * mass_deviation):
-                        mz_list.append(spec[C.SpecMZ][np.argmin(e)])
-                    else:
-                        break
-                m, i = get_closest_ion(mz_mean, spec[C.SpecMZ], spec[C.SpecINT])
-                roi_ms1.append(MS1Ion(p, ms1.at[p, C.RT], m, i))
+def _closest_peak(mz: np.ndarray, value: float) -> int:
+    # same as `np.abs(value - mz).argmin()` on a sorted array, by bisection
+    right = mz.searchsorted(value, "left")
+    if right == 0:
+        return 0
+    left = mz.searchsorted(mz[right - 1], "left")
+    if right == mz.size or value - mz[left] <= mz[right] - value:
+        return left
+    return right
+
+
+def _trace_rois(
+    ms1: SpectrumStore,
+    precursor_mz: np.ndarray,
+    ms1_idx: np.ndarray,
+    seeds: np.ndarray,
+    mass_deviation: float,
+    progress: ProgressFunc,
+) -> tuple[np.ndarray, list[int], RoiTable]:
+    """
+    Follow the MS1 trace of the MS2 scans `seeds` (in this order), see `ms2_ms1_roi`.
+
+    All MS2 scans can join a ROI, not only `seeds`. Returns the ROI of every MS2 scan
+    (-1 if none), the seed of every ROI and their traces.
+    """
+    # MS1 scan labels to positions
+    labels = ms1.index.to_numpy()
+    first_label, last_label = int(labels.min()), int(labels.max())
+    label_pos = np.full(last_label - first_label + 1, -1, dtype=np.int64)
+    label_pos[labels - first_label] = np.arange(labels.size)
+    label_pos = label_pos.tolist()
+
+    def ms1_scan(p):
+        pos = label_pos[p - first_label] if first_label <= p <= last_label else -1
+        if pos < 0:
+            raise KeyError(p)
+        return pos, *ms1.scan(pos)
+
+    groups = _PrecursorGroups(ms1_idx, precursor_mz, first_label, last_label)
+
+    roi_id = np.full(precursor_mz.size, -1, dtype=int)
+    roi_seeds = []
+    # points of the traces: ROI, MS1 scan label, position and peak (-1 if the scan is empty)
+    point_roi, point_label, point_pos, point_peak = [], [], [], []
+    mz_list = np.empty(64)
 
+    for row in progress(seeds.tolist(), total=seeds.size):
+        if roi_id[row] != -1 or ms1_idx[row] < 0:
+            continue
+        current_roi_idx = len(roi_seeds)
+        roi_seeds.append(row)
+        roi_id[row] = current_roi_idx
+        # m/z of the trace, the mean is taken over the whole list like `np.mean(list)`
+        mz_list[0] = precursor_mz[row]
+        n_mz = 1
+
+        ms1_idx_start = int(ms1_idx[row])
+        pos, spec_mz, _ = ms1_scan(ms1_idx_start)
+        n_points = 1
+        point_label.append(ms1_idx_start)
+        point_pos.append(pos)
+        if spec_mz.size:
+            point_peak.append(int(ms1.offsets[pos]) + _closest_peak(spec_mz, precursor_mz[row]))
+        else:
+            point_peak.append(-1)
+        for step, end in ((1, last_label), (-1, first_label)):
             p = ms1_idx_start
-            # backward:
-            while p > ms1.index.min():
-                mz_mean = np.mean(mz_list)
-                p -= 1
-                spec = ms1.loc[p]
-                ms2_hit = (ms2[C.MS1IDX] == p) & np.isclose(
-                    ms2[C.PrecursorMZ], mz_mean, rtol=mass_deviation, atol=0
-                )
-
-                if ms2_hit.any():
-                    roi_id[ms2_hit] = current_roi_idx
-                    mz_list.extend(ms2.loc[ms2_hit, C.PrecursorMZ].to_list())
+            while p != end:
+                mz_mean = np.add.reduce(mz_list[:n_mz]) / n_mz
+                p += step
+                pos, spec_mz, _ = ms1_scan(p)
+                hits = groups.hits(p, mz_mean, mass_deviation)
+                if hits.size:
+                    roi_id[hits] = current_roi_idx
+                    new_mz = precursor_mz[hits]
                 else:
-                    e = np.abs(spec[C.SpecMZ] - mz_mean)
-                    if np.any(e <= mz_mean * mass_deviation):
-                        mz_list.append(spec[C.SpecMZ][np.argmin(e)])
-                    else:
+                    if not spec_mz.size:
+                        break
+                    k = _closest_peak(spec_mz, mz_mean)
+                    if not abs(spec_mz[k] - mz_mean) <= mz_mean * mass_deviation:
                         break
-                m, i = get_closest_ion(mz_mean, spec[C.SpecMZ], spec[C.SpecINT])
-                roi_ms1.append(MS1Ion(p, ms1.at[p, C.RT], m, i))
-            ms2_idx_to_ms1_roi[current_roi_idx] = pd.DataFrame(roi_ms1)
-    df = pd.concat((ms2[C.PrecursorMS1Int], roi_id), axis=1)
-    return df, ms2_idx_to_ms1_roi
+                    new_mz = spec_mz[k:k + 1]
+                if n_mz + new_mz.size > mz_list.size:
+                    mz_list = np.resize(mz_list, 2 * (n_mz + new_mz.size))
+                mz_list[n_mz:n_mz + new_mz.size] = new_mz
+                n_mz += new_mz.size
+                n_points += 1
+                point_label.append(p)
+                point_pos.append(pos)
+                if spec_mz.size:
+                    point_peak.append(int(ms1.offsets[pos]) + _closest_peak(spec_mz, mz_mean))
+                else:
+                    point_peak.append(-1)
+        point_roi.append(np.full(n_points, current_roi_idx))
+    return roi_id, roi_seeds, _roi_table(ms1, len(roi_seeds), point_roi, point_label, point_pos, point_peak)
+
+
+def _roi_table(ms1: SpectrumStore, n_rois: int, point_roi, point_label, point_pos, point_peak) -> RoiTable:
+    # points of every ROI sorted by MS1 scan
+    point_roi = np.concatenate(point_roi) if point_roi else np.zeros(0, dtype=np.int64)
+    point_label = np.asarray(point_label, dtype=np.int64)
+    order = np.lexsort((point_label, point_roi))
+    point_roi = point_roi[order]
+    point_pos = np.asarray(point_pos, dtype=np.int64)[order]
+    point_peak = np.asarray(point_peak, dtype=np.int64)[order]
+    has_peak = point_peak >= 0
+    mz = np.full(point_peak.size, np.nan)
+    mz[has_peak] = ms1.mz_at(point_peak[has_peak])
+    inten = np.full(point_peak.size, np.nan)
+    inten[has_peak] = ms1.intensity[point_peak[has_peak]]
+    points = pd.DataFrame(
+        {
+            C.ROIGroupID: point_roi,
+            "MS1_IDX": point_label[order],
+            "RT": ms1.meta[C.RT].to_numpy()[point_pos],
+            "MZ": mz,
+            "INT": inten,
+        }
+    )
+    offsets = np.zeros(n_rois + 1, dtype=np.int64)
+    np.cumsum(np.bincount(point_roi, minlength=n_rois), out=offsets[1:])
+    return RoiTable(points, offsets, peaks=point_peak)
+
+
+def _trace_window(ms1, precursor_mz, ms1_idx, seeds, mass_deviation):
+    # worker of `ms2_ms1_roi`, only the MS2 scans met are sent back
+    roi_id, roi_seeds, rois = _trace_rois(ms1, precursor_mz, ms1_idx, seeds, mass_deviation, check_progress(False))
+    rows = np.flatnonzero(roi_id >= 0)
+    return rows, roi_id[rows], roi_seeds, rois
+
+
+def _mz_windows(precursor_mz: np.ndarray, ms1_idx: np.ndarray, mass_deviation: float, n_windows: int):
+    """
+    Split the MS2 scans with a MS1 scan into about `n_windows` windows of precursor m/z
+    of similar size, only cut where consecutive precursors are further apart than the tolerance.
+    """
+    rows = np.flatnonzero(ms1_idx >= 0)
+    rows = rows[np.argsort(precursor_mz[rows], kind="stable")]
+    mz = precursor_mz[rows]
+    cuts = np.flatnonzero(np.diff(mz) > 2 * mass_deviation * np.abs(mz[1:])) + 1
+    if cuts.size and n_windows > 1:
+        targets = np.arange(1, n_windows) * rows.size / n_windows
+        cuts = np.unique(cuts[np.minimum(cuts.searchsorted(targets), cuts.size - 1)])
+    else:
+        cuts = cuts[:0]
+    return [np.sort(w) for w in np.split(rows, cuts) if w.size]
+
+
+def _parallel_trace_rois(ms1, precursor_mz, ms1_idx, mass_deviation, progress, n_jobs):
+    windows = _mz_windows(precursor_mz, ms1_idx, mass_deviation, 4 * joblib.effective_n_jobs(n_jobs))
+    if not windows:
+        # no MS2 scan with a MS1 scan, nothing to trace
+        return np.full(precursor_mz.size, -1, dtype=int), _roi_table(ms1, 0, [], [], [], [])
+    results = [None] * len(windows)
+    parallel = ProgressParallel(n_jobs=n_jobs)
+    todo = list(range(len(windows)))
+    while todo:
+        tasks = [
+            joblib.delayed(_trace_window)(ms1, precursor_mz, ms1_idx, windows[w], mass_deviation) for w in todo
+        ]
+        for w, res in zip(todo, parallel(tasks, progress=progress)):
+            results[w] = res
+        # windows whose traces met MS2 scans of another window are merged and traced again
+        window_of = np.full(precursor_mz.size, -1, dtype=np.int64)
+        for w, rows in enumerate(windows):
+            window_of[rows] = w
+        parent = list(range(len(windows)))
+
+        def root(w):
+            while parent[w] != w:
+                w = parent[w]
+            return w
+
+        for w, (rows, *_) in enumerate(results):
+            for other in np.unique(window_of[rows]).tolist():
+                if other >= 0 and root(other) != root(w):
+                    parent[root(other)] = root(w)
+        merged = {}
+        for w in range(len(windows)):
+            merged.setdefault(root(w), []).append(w)
+        todo = []
+        new_windows, new_results = [], []
+        for members in merged.values():
+            if len(members) == 1:
+                new_windows.append(windows[members[0]])
+                new_results.append(results[members[0]])
+            else:
+                todo.append(len(new_windows))
+                new_windows.append(np.sort(np.concatenate([windows[w] for w in members])))
+                new_results.append(None)
+        windows, results = new_windows, new_results
+
+    # ROIs are numbered by seed, like in the serial order
+    seeds = np.array([s for _, _, roi_seeds, _ in results for s in roi_seeds], dtype=np.int64)
+    rois = RoiTable.concat([res[3] for res in results])
+    new_id = np.empty(seeds.size, dtype=np.int64)
+    new_id[np.argsort(seeds, kind="stable")] = np.arange(seeds.size)
+    roi_id = np.full(precursor_mz.size, -1, dtype=int)
+    shift = 0
+    for rows, ids, roi_seeds, _ in results:
+        roi_id[rows] = new_id[shift + ids]
+        shift += len(roi_seeds)
+    return roi_id, rois.take(np.argsort(new_id))
+
+
+def ms2_ms1_roi(
+    ms2: pd.DataFrame | SpectrumStore,
+    ms1: pd.DataFrame | SpectrumStore,
+    mass_deviation,
+    progress: ProgressFunc | bool = True,
+    n_jobs: int = 1,
+):
+    """
+    Group MS2 scans into regions of interest (ROI), by following the mass trace
+    of their precursor through the MS1 scans.
+
+    For each MS2 scan not in a ROI yet, the trace is extended forward then backward
+    from its MS1 scan while the next MS1 scan has a MS2 precursor or a peak within
+    `mass_deviation` of the mean m/z of the trace. MS2 scans met on the way join the ROI.
+
+    MS2 precursors are grouped by MS1 scan and sorted by m/z, and the peaks of each
+    MS1 scan are searched by bisection, so the cost grows with the length of the traces
+    rather than with the number of scans.
+
+    With `n_jobs` other than 1, precursors are split into non-overlapping m/z windows
+    traced in parallel processes. The MS1 arrays are shared read-only with the workers,
+    through the memory mapping of `joblib` (or of a lazy `SpectrumStore`). Windows whose
+    traces met MS2 scans of another window are merged and traced again, so the result
+    is the same as with `n_jobs=1`.
+
+    Parameters
+    ----------
+    ms2 : pd.DataFrame | SpectrumStore
+        MS2 scans, only their scan information is used.
+    ms1 : pd.DataFrame | SpectrumStore
+        MS1 scans.
+    mass_deviation : float
+        Relative tolerance of the m/z of the trace.
+    progress : ProgressFunc | bool, optional
+        If True, show progress using `tqdm.tqdm`. If False, show nothing.
+        Optionally, passing a `ProgressFunc` like object will update progress using this object,
+        by default True.
+    n_jobs : int, optional
+        Number of processes, as in `joblib.Parallel`, by default 1
+
+    Returns
+    -------
+    tuple[pd.DataFrame, RoiTable]
+        `MS1INT` and `ROIGroupID` of every MS2 scan (-1 for scans without MS1 scan),
+        and the MS1 trace of every ROI, sorted by scan (`MS1_IDX`), whereas the traces
+        formerly listed the forward points then the backward ones in the order they were
+        met. The points of a scan without peak have NaN `MZ` and `INT`.
+        Use `RoiTable.traces` for a `dict` like view of one DataFrame per ROI.
+    """
+    progress = check_progress(progress)
+    meta = ms2.meta if isinstance(ms2, SpectrumStore) else ms2
+    ms1 = as_store(ms1)
+    precursor_mz = meta[C.PrecursorMZ].to_numpy(dtype=np.float64)
+    ms1_idx = meta[C.MS1IDX].to_numpy()
+
+    if n_jobs == 1 or len(meta) == 0:
+        roi_id, _, rois = _trace_rois(ms1, precursor_mz, ms1_idx, np.arange(len(meta)), mass_deviation, progress)
+    else:
+        roi_id, rois = _parallel_trace_rois(ms1, precursor_mz, ms1_idx, mass_deviation, progress, n_jobs)
+    roi_id = pd.Series(roi_id, index=meta.index, name=C.ROIGroupID)
+    df = pd.concat((meta[C.PrecursorMS1Int], roi_id), axis=1)
+    return df, rois
+
+
+def eic(target_mz, ms1: pd.DataFrame | SpectrumStore, rtol=5e-6, atol=0, cache: Optional["EICCache"] = None):
+    """
+    Extracted ion chromatogram (EIC) of `target_mz`: the summed intensity of the peaks
+    within tolerance, in every MS1 scan.
+
+    Parameters
+    ----------
+    target_mz : float
+        m/z of the target.
+    ms1 : pd.DataFrame | SpectrumStore
+        MS1 scans.
+    rtol : float, optional
+        Relative tolerance, by default 5e-6
+    atol : float, optional
+        Absolute tolerance, by default 0
+    cache : EICCache, optional
+        Reuse the EICs already extracted through this cache, by default None
+
+    Returns
+    -------
+    pd.DataFrame
+        `RT` and `EIC_INT` of every MS1 scan.
+    """
+    if cache is not None:
+        return cache.eic(target_mz, ms1, rtol, atol)
+    ms1 = as_store(ms1)
+    tic_int = eic_matrix(target_mz, ms1, rtol, atol).to_numpy()[0]
+    return pd.DataFrame(data={C.RT: ms1.meta[C.RT], "EIC_INT": tic_int})
+
+
+class EICCache:
+    """
+    Least recently used cache of EICs, for `eic` and `search_from_another_ms1`.
+
+    EICs are keyed by run (the `ms1` object, entries are dropped when it is garbage collected),
+    m/z rounded to `mz_quantum`, and tolerance. Target m/z closer than `mz_quantum` share their EIC.
+    A run must not be edited in place while its EICs are cached, `clear` the cache first.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of EICs kept, by default 4096
+    mz_quantum : float, optional
+        m/z resolution of the keys, by default `spectra.MZ_QUANTUM` (about 1e-6 Da)
+    """
+
+    def __init__(self, maxsize: int = 4096, mz_quantum: float = MZ_QUANTUM) -> None:
+        self.maxsize = maxsize
+        self.mz_quantum = mz_quantum
+        self.hits = 0
+        self.misses = 0
+        self._eics = OrderedDict()
+        # id of the run -> (store converted from a DataFrame, RT, RT sorted, RT order)
+        self._runs = {}
+
+    def __len__(self) -> int:
+        return len(self._eics)
+
+    def __repr__(self) -> str:
+        return f"<EICCache: {len(self)}/{self.maxsize} EICs, {self.hits} hits, {self.misses} misses>"
+
+    def cache_info(self) -> EICCacheInfo:
+        """Same as `functools.lru_cache`."""
+        return EICCacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def clear(self) -> None:
+        """Drop all EICs and reset the counters."""
+        self._eics.clear()
+        self._runs.clear()
+        self.hits = self.misses = 0
+
+    def _run(self, ms1: pd.DataFrame | SpectrumStore) -> int:
+        run = id(ms1)
+        if run not in self._runs:
+            store = as_store(ms1)
+            rt = store.meta[C.RT]
+            order = np.argsort(rt.to_numpy(), kind="stable")
+            # a store given as run must not be kept alive by the cache
+            converted = None if store is ms1 else store
+            self._runs[run] = (converted, rt, rt.to_numpy()[order], order)
+            weakref.finalize(ms1, self._forget, run)
+        return run
+
+    def _forget(self, run: int) -> None:
+        self._runs.pop(run, None)
+        for key in [key for key in self._eics if key[0] == run]:
+            del self._eics[key]
+
+    def _intensity(self, target_mz: float, ms1, rtol: float, atol: float) -> tuple[int, np.ndarray]:
+        # EIC intensities of the run, in the order of its scans
+        run = self._run(ms1)
+        key = (run, int(round(target_mz / self.mz_quantum)), float(rtol), float(atol))
+        tic_int = self._eics.get(key)
+        if tic_int is not None:
+            self.hits += 1
+            self._eics.move_to_end(key)
+            return run, tic_int
+        self.misses += 1
+        store = self._runs[run][0]
+        tic_int = eic_matrix(target_mz, ms1 if store is None else store, rtol, atol).to_numpy()[0]
+        tic_int.flags.writeable = False
+        self._eics[key] = tic_int
+        if len(self._eics) > self.maxsize:
+            self._eics.popitem(last=False)
+        return run, tic_int
+
+    def eic(self, target_mz: float, ms1: pd.DataFrame | SpectrumStore, rtol: float = 5e-6, atol: float = 0):
+        """Same as `tools.eic`."""
+        run, tic_int = self._intensity(target_mz, ms1, rtol, atol)
+        return pd.DataFrame(data={C.RT: self._runs[run][1], "EIC_INT": tic_int.copy()})
+
+    def search(self, target_mz: float, rt: float, ms1: pd.DataFrame | SpectrumStore, mass_acc: float, rt_atol=1):
+        """Same as `tools.search_from_another_ms1`."""
+        run, tic_int = self._intensity(target_mz, ms1, mass_acc, 0)
+        _, _, sorted_rt, order = self._runs[run]
+        start = sorted_rt.searchsorted(rt - rt_atol, "right")
+        stop = sorted_rt.searchsorted(rt + rt_atol, "left")
+        return tic_int[order[start:stop]].max() if stop > start else np.nan
+
+
+def eic_matrix(
+    target_mz: ArrayLike,
+    ms1: pd.DataFrame | SpectrumStore,
+    rtol: float | ArrayLike = 5e-6,
+    atol: float | ArrayLike = 0,
+    rt_range: Optional[ArrayLike] = None,
+    sparse: bool = False,
+) -> pd.DataFrame:
+    """
+    Extracted ion chromatograms (EIC) of many targets at once.
+
+    Same intensities as `eic` for every target, but the peaks of each scan are searched
+    by bisection for all targets together, and only the scans in the RT window of a target
+    are visited.
+
+    Parameters
+    ----------
+    target_mz : ArrayLike
+        m/z of the targets.
+    ms1 : pd.DataFrame | SpectrumStore
+        MS1 scans.
+    rtol : float | ArrayLike, optional
+        Relative tolerance, per target or for all, by default 5e-6
+    atol : float | ArrayLike, optional
+        Absolute tolerance, per target or for all, by default 0
+    rt_range : ArrayLike, optional
+        RT window `(start, end)` of every target (shape `(n_targets, 2)`) or of all (shape `(2,)`),
+        bounds excluded. By default all scans.
+    sparse : bool, optional
+        Return the points in the RT windows only, as a long table, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        If not `sparse`, the summed intensity of every target (rows) in every MS1 scan (columns,
+        labelled by the index of `ms1`), NaN outside the RT window.
+        If `sparse`, columns `Target` (position in `target_mz`), `MS1_IDX`, `RT` and `EIC_INT`,
+        sorted by target then RT.
+    """
+    ms1 = as_store(ms1)
+    target_mz = np.atleast_1d(np.asarray(target_mz, dtype=np.float64))
+    n_targets = target_mz.size
+    # as in `np.isclose(peak_mz, target_mz)`
+    tol = np.broadcast_to(atol + rtol * np.abs(target_mz), (n_targets,))
+
+    rt = ms1.meta[C.RT].to_numpy()
+    # scans are usually sorted by RT already
+    rt_order = np.arange(rt.size) if np.all(rt[1:] >= rt[:-1]) else np.argsort(rt, kind="stable")
+    if rt_range is None:
+        first = np.zeros(n_targets, dtype=np.int64)
+        last = np.full(n_targets, len(ms1), dtype=np.int64)
+    else:
+        rt_range = np.broadcast_to(np.reshape(np.asarray(rt_range, dtype=np.float64), (-1, 2)), (n_targets, 2))
+        first = rt[rt_order].searchsorted(rt_range[:, 0], "right")
+        last = np.maximum(rt[rt_order].searchsorted(rt_range[:, 1], "left"), first)
+    counts = last - first
 
+    pair_target = []
+    pair_scan = []
+    pair_int = []
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    t_start = 0
+    while t_start < n_targets:
+        # targets whose scans fit in a chunk, at least one
+        t_stop = max(int(bounds.searchsorted(bounds[t_start] + _EIC_CHUNK, "right")) - 1, t_start + 1)
+        targets = np.repeat(np.arange(t_start, t_stop), counts[t_start:t_stop])
+        scans = rt_order[_gather_index(first[t_start:t_stop], counts[t_start:t_stop])]
+        mz = target_mz[targets]
+        # candidates are searched in a slightly wider window, then tested exactly
+        reach = _search_reach(tol[targets], mz)
+        lo = ms1.searchsorted(mz - reach, scans, "left")
+        n_cand = ms1.searchsorted(mz + reach, scans, "right") - lo
+        pairs = np.repeat(np.arange(targets.size), n_cand)
+        cand = _gather_index(lo, n_cand)
+        match = np.abs(ms1.mz_at(cand) - mz[pairs]) <= tol[targets[pairs]]
+        pair_target.append(targets)
+        pair_scan.append(scans)
+        pair_int.append(
+            np.bincount(pairs[match], weights=ms1.intensity[cand[match]], minlength=targets.size)
+        )
+        t_start = t_stop
+    pair_target = np.concatenate(pair_target) if pair_target else np.zeros(0, dtype=np.int64)
+    pair_scan = np.concatenate(pair_scan) if pair_scan else np.zeros(0, dtype=np.int64)
+    pair_int = np.concatenate(pair_int) if pair_int else np.zeros(0)
 
-def eic(target_mz, ms1, rtol=5e-6, atol=0):
-    def _f(s):
-        sel_int = s[C.SpecINT][np.isclose(s[C.SpecMZ], target_mz, rtol=rtol, atol=atol)]
-        return sel_int.sum()
+    if sparse:
+        return pd.DataFrame(
+            {
+                "Target": pair_target,
+                "MS1_IDX": ms1.index.to_numpy()[pair_scan],
+                C.RT: rt[pair_scan],
+                "EIC_INT": pair_int,
+            }
+        )
+    matrix = np.full((n_targets, len(ms1)), np.nan)
+    matrix[pair_target, pair_scan] = pair_int
+    return pd.DataFrame(matrix, columns=ms1.index)
 
-    tic_int = ms1[[C.SpecMZ, C.SpecINT]].apply(_f, axis=1)
-    return pd.DataFrame(data={C.RT: ms1[C.RT], "EIC_INT": tic_int})
 
+def search_from_another_ms1(target_mz, rt, ms1, mass_acc, rt_atol=1, cache: Optional[EICCache] = None):
+    """
+    Most intense EIC point of `target_mz` within `rt_atol` (bounds excluded) of `rt`,
+    NaN if no MS1 scan is in the window.
 
-def search_from_another_ms1(target_mz, rt, ms1, mass_acc, rt_atol=1):
-    eic_df = eic(target_mz, ms1, mass_acc)
-    sel = np.logical_and(eic_df[C.RT] > (rt - rt_atol), eic_df[C.RT] < (rt + rt_atol))
-    return eic_df.loc[sel, "EIC_INT"].max()
+    Only the MS1 scans in the RT window are searched, see `eic_matrix`. With a `cache`,
+    the EIC of the whole run is extracted once and reused by the next searches of the same m/z.
+    """
+    if cache is not None:
+        return cache.search(target_mz, rt, ms1, mass_acc, rt_atol)
+    return eic_matrix(target_mz, ms1, mass_acc, rt_range=(rt - rt_atol, rt + rt_atol)).iloc[0].max()
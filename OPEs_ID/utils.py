@@ -20,8 +20,8 @@ class ProgressParallel(joblib.Parallel):
         sig = inspect.signature(super().__init__)
         bind_sig = sig.bind(*args, **kwargs)
         bind_sig.apply_defaults()
-        if bind_sig.arguments["return_as"] == "list":
-            self.__return_list = True
+        self.__return_list = bind_sig.arguments["return_as"] == "list"
+        if self.__return_list:
             bind_sig.arguments["return_as"] = "generator"
         super().__init__(*bind_sig.args, **bind_sig.kwargs)
 